@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:31
+
+from django.db import migrations
+import django.db.models.deletion
+import util.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actor', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='actor',
+            name='locale',
+            field=util.fields.ReferenceForeignKey(blank=True, help_text='Locale', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='actor_actor_set', to='util.Locale', verbose_name='locale'),
+        ),
+        migrations.AlterField(
+            model_name='actor',
+            name='timezone',
+            field=util.fields.ReferenceForeignKey(help_text='Timezone', on_delete=django.db.models.deletion.PROTECT, related_name='actor_actor_set', to='util.TimeZone', verbose_name='timezone'),
+        ),
+    ]
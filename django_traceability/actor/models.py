@@ -1,13 +1,76 @@
 from functools import lru_cache
 
-from django.db.models import CharField
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Case, CharField, Value, When
 from django.utils.translation import ugettext_lazy as _
 
+from polymorphic.managers import PolymorphicManager
 from polymorphic.models import PolymorphicModel
+from polymorphic.query import PolymorphicQuerySet
 
 from util.mixins import SettingsMixin, CorporateMixin, StatusMixin, factory_image_mixin
 
 
+def _type_name(verbose_name):
+    """Display name of an actor type, from its model verbose name"""
+    return str(verbose_name).split()[-1].capitalize()
+
+
+@lru_cache(maxsize=None)
+def get_actor_types():
+    """Map {polymorphic_ctype_id: type name} of all actor models, built once per process"""
+    models = [model for model in apps.get_models() if issubclass(model, Actor)]
+    content_types = ContentType.objects.get_for_models(*models, for_concrete_models=False)
+    return {ctype.pk: _type_name(model._meta.verbose_name) for model, ctype in content_types.items()}
+
+
+def get_actor_type(ctype_id):
+    """Type name of an actor from its polymorphic_ctype_id"""
+    try:
+        return get_actor_types()[ctype_id]
+    except KeyError:  # Model registered after the map was built
+        return _type_name(ContentType.objects.get_for_id(ctype_id).name)
+
+
+class ActorQuerySet(PolymorphicQuerySet):
+    """QuerySet used by Actor"""
+
+    def with_actor_type(self):
+        """Annotate actor_type_name, computed by the database from the type map"""
+        return self.annotate(actor_type_name=Case(
+            *[When(polymorphic_ctype_id=ctype_id, then=Value(name)) for ctype_id, name in get_actor_types().items()],
+            default=Value(""),
+            output_field=CharField(),
+        ))
+
+    def listing(self):
+        """Base fields and type of actors, with a single query (no subclass fan-out)"""
+        return self.non_polymorphic().select_related("polymorphic_ctype")
+
+    def upcast(self, actors):
+        """Real instances of a page of actors, with one IN query per actor type"""
+        return self.get_real_instances(list(actors))
+
+
+class ActorManager(PolymorphicManager):
+    """Manager for Actor"""
+
+    queryset_class = ActorQuerySet
+
+    def listing(self):
+        """Base fields and type of actors, with a single query"""
+        return self.get_queryset().listing()
+
+    def with_actor_type(self):
+        """Annotate the type name of each actor"""
+        return self.get_queryset().with_actor_type()
+
+    def upcast(self, actors):
+        """Real instances of a page of actors listed with listing()"""
+        return self.get_queryset().upcast(actors)
+
+
 class Actor(SettingsMixin, CorporateMixin, factory_image_mixin("logo", "Logo"), StatusMixin, PolymorphicModel):
     """Actor base class"""
 
@@ -19,11 +82,14 @@ class Actor(SettingsMixin, CorporateMixin, factory_image_mixin("logo", "Logo"),
         blank=False,
     )
 
+    objects = ActorManager()
+
     @property
-    @lru_cache(maxsize=1)
     def actor_type(self):
         """Provides a direct way to know the type of association"""
-        return self.polymorphic_ctype.name.split()[-1].capitalize()
+        if getattr(self, "actor_type_name", None):
+            return self.actor_type_name
+        return get_actor_type(self.polymorphic_ctype_id)
 
     #
     # Meta class
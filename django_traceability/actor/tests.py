@@ -1,3 +1,92 @@
-from django.test import TestCase
+"""
+Test cases
 
-# Create your tests here.
+TODO.
+"""
+
+from django.test import TransactionTestCase
+
+from actor.models import Actor, get_actor_types
+from util.models import Status, TimeZone
+from util.registry import reference_registry, status_registry
+from util.tests import TestModelsMixin
+
+
+class Company(Actor):
+    """Actor type used for tests"""
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Company Meta class"""
+
+        app_label = "actor"
+        managed = False  # Table created by the test case, not by migrations
+        verbose_name = "company"
+
+
+class Person(Actor):
+    """Actor type used for tests"""
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Person Meta class"""
+
+        app_label = "actor"
+        managed = False  # Table created by the test case, not by migrations
+        verbose_name = "natural person"
+
+
+class ActorTestCase(TestModelsMixin, TransactionTestCase):
+    """Listing actors of several types"""
+
+    models = (Company, Person)
+
+    def setUp(self):
+        super().setUp()
+        status_registry.invalidate()
+        reference_registry.invalidate()
+        get_actor_types.cache_clear()  # Content types are recreated by each flush
+        Status.objects.create(model="actor.actor", label="active", is_default=True)
+        timezone = TimeZone.objects.create(label="Europe/Paris")
+        for index in range(4):
+            for model in (Actor, Company, Person):
+                model.objects.create(label="{} {}".format(model.__name__, index), tin=str(index), timezone=timezone)
+
+    def tearDown(self):
+        super().tearDown()
+        status_registry.invalidate()
+        reference_registry.invalidate()
+        get_actor_types.cache_clear()
+
+    def test_listing(self):
+        """A page of actors of all types is listed with one query"""
+        with self.assertNumQueries(1):
+            actors = list(Actor.objects.listing().order_by("pk"))
+            self.assertEqual([actor.polymorphic_ctype.model for actor in actors[:3]], ["actor", "company", "person"])
+        self.assertEqual({type(actor) for actor in actors}, {Actor})
+
+    def test_upcast(self):
+        """A page is upcast with one IN query per actor type"""
+        page = list(Actor.objects.listing().order_by("pk")[:9])
+        with self.assertNumQueries(2):
+            actors = Actor.objects.upcast(page)
+        self.assertEqual([type(actor) for actor in actors], [Actor, Company, Person] * 3)
+        self.assertEqual([actor.pk for actor in actors], [actor.pk for actor in page])
+
+    def test_actor_type(self):
+        """Type names are read from a map built once, not per row"""
+        get_actor_types()
+        with self.assertNumQueries(1):
+            actors = list(Actor.objects.listing().order_by("pk")[:3])
+            self.assertEqual([actor.actor_type for actor in actors], ["Actor", "Company", "Person"])
+        with self.assertNumQueries(3):  # One query per type, none for type names
+            self.assertEqual(
+                sorted({actor.actor_type for actor in Actor.objects.all()}), ["Actor", "Company", "Person"],
+            )
+
+    def test_with_actor_type(self):
+        """The type computed by the database is the one of the property, for every type"""
+        annotated = list(Actor.objects.with_actor_type().non_polymorphic())
+        self.assertEqual(len(annotated), 12)
+        types = {actor.pk: actor.actor_type for actor in Actor.objects.all()}
+        for actor in annotated:
+            self.assertEqual(actor.actor_type_name, types[actor.pk])
+            self.assertEqual(actor.actor_type, types[actor.pk])
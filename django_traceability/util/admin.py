@@ -8,6 +8,7 @@ from django.contrib import admin
 
 from util.models import (
     Status,
+    StatusTransition,
     Country,
     StateCategory,
     State,
@@ -16,6 +17,7 @@ from util.models import (
     UnitCategory,
     Unit,
     Currency,
+    CurrencyRate,
 )
 
 
@@ -25,13 +27,26 @@ class StatusAdmin(admin.ModelAdmin):
     list_display = ("label", "model")
 
 
+class StatusTransitionAdmin(admin.ModelAdmin):
+    """Customize StatusTransition admin interface"""
+
+    list_display = ("model", "object_id", "from_status", "to_status", "actor", "date")
+
+
 class StateAdmin(admin.ModelAdmin):
     """Customize Country admin interface"""
 
     list_display = ("label", "country")
 
 
+class CurrencyRateAdmin(admin.ModelAdmin):
+    """Customize CurrencyRate admin interface"""
+
+    list_display = ("currency", "value", "start", "end")
+
+
 admin.site.register(Status, StatusAdmin)
+admin.site.register(StatusTransition, StatusTransitionAdmin)
 admin.site.register(Country)
 admin.site.register(StateCategory)
 admin.site.register(State, StateAdmin)
@@ -40,3 +55,4 @@ admin.site.register(TimeZone)
 admin.site.register(UnitCategory)
 admin.site.register(Unit)
 admin.site.register(Currency)
+admin.site.register(CurrencyRate, CurrencyRateAdmin)
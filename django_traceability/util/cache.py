@@ -0,0 +1,74 @@
+"""
+Versioned cache of hierarchy traversals.
+
+Each hierarchical model has a version counter stored in Django's cache. It
+is part of every cached traversal key, so bumping it invalidates all the
+cached traversals of the model at once. Stale entries simply expire.
+
+The cache alias can be chosen with the UTIL_HIERARCHY_CACHE setting.
+"""
+
+from hashlib import md5
+from time import time
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+_MISSING = object()
+
+
+def _get_cache():
+    """Cache backend used for hierarchies"""
+    return caches[getattr(settings, "UTIL_HIERARCHY_CACHE", DEFAULT_CACHE_ALIAS)]
+
+
+def _version_key(model):
+    """Key of the version counter of a model"""
+    return "util.hierarchy.{}.version".format(model._meta.label_lower)
+
+
+def _initial_version():
+    """
+    First version of a counter.
+
+    Based on the clock, so that a counter evicted from the cache never
+    restarts on a version whose entries may still be cached.
+    """
+    return int(time() * 1000)
+
+
+def get_tree_version(model):
+    """Current version of the hierarchy of a model"""
+    cache = _get_cache()
+    key = _version_key(model)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), timeout=None)
+        version = cache.get(key, _initial_version())
+    return version
+
+
+def bump_tree_version(model):
+    """Invalidate all cached traversals of the hierarchy of a model"""
+    cache = _get_cache()
+    key = _version_key(model)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, _initial_version(), timeout=None)
+
+
+def cached_traversal(model, parts, compute, timeout=DEFAULT_TIMEOUT):
+    """Get a traversal result from the cache, computing it when missing"""
+    cache = _get_cache()
+    key = "util.hierarchy.{}.{}.{}".format(
+        model._meta.label_lower,
+        get_tree_version(model),
+        md5(repr(parts).encode()).hexdigest(),
+    )
+    result = cache.get(key, _MISSING)
+    if result is _MISSING:
+        result = compute()
+        cache.set(key, result, timeout)
+    return result
@@ -0,0 +1,251 @@
+"""
+Conversion services.
+
+Unit conversions read their factors from the reference registry, so they
+never query the database once it is loaded. Currency conversions load the
+rates of a whole batch with a single range query. NumPy is optional: when
+installed, arrays are converted with vectorized operations.
+"""
+
+from bisect import bisect_right
+from collections import defaultdict
+import datetime
+
+from django.db.models import Q
+from django.utils.timezone import is_naive, make_aware
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+from .models import Currency, CurrencyRate, Unit
+from .registry import reference_registry
+
+
+class IncompatibleUnits(ValueError):
+    """Units of different categories can not be converted"""
+
+
+class MissingRate(LookupError):
+    """No rate is in effect for a currency at a date"""
+
+
+def as_datetime(value):
+    """
+    Aware datetime of a date given to currency conversions.
+
+    Dates are taken at midnight, and naive datetimes in the current time zone,
+    as rate periods are stored as aware datetimes.
+    """
+    if not isinstance(value, datetime.date):
+        raise TypeError("Expected a date or a datetime, got {!r}".format(value))
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time.min)
+    return make_aware(value) if is_naive(value) else value
+
+
+class FactorMatrix:
+    """Conversion factors between all the units of a category"""
+
+    def __init__(self, units):
+        self.units = tuple(sorted(units, key=lambda unit: unit.pk))
+        self.index = {unit.pk: position for position, unit in enumerate(self.units)}
+        values = [unit.value for unit in self.units]
+        if numpy is not None:
+            self.values = numpy.array(values, dtype=float)
+            self.pks = numpy.array([unit.pk for unit in self.units])
+            # factors[i, j] converts an amount of unit i into unit j
+            self.factors = self.values[:, numpy.newaxis] / self.values[numpy.newaxis, :]
+        else:
+            self.values = values
+            self.factors = [[source / target for target in values] for source in values]
+
+    def factor(self, from_pk, to_pk):
+        """Factor converting an amount of a unit into another one"""
+        return self.factors[self.index[from_pk]][self.index[to_pk]]
+
+
+class UnitConverter:
+    """Convert amounts between units of the same category"""
+
+    def __init__(self):
+        self._matrices = {}
+
+    @staticmethod
+    def get_unit_pk(unit):
+        """Primary key of a unit (unit may be a Unit or a primary key)"""
+        return unit.pk if isinstance(unit, Unit) else unit
+
+    def get_unit(self, unit):
+        """Get a unit from the registry (unit may be a Unit or a primary key)"""
+        return reference_registry.get(Unit, self.get_unit_pk(unit))
+
+    def get_matrix(self, category_id):
+        """Factor matrix of a category, rebuilt when units are reloaded"""
+        table = reference_registry.get_table(Unit)
+        cached = self._matrices.get(category_id)
+        if cached is None or cached[0] is not table:
+            units = [unit for unit in table if unit.category_id == category_id]
+            cached = self._matrices[category_id] = (table, FactorMatrix(units))
+        return cached[1]
+
+    def get_factor(self, from_unit, to_unit):
+        """Factor converting an amount of from_unit into to_unit"""
+        from_unit, to_unit = self.get_unit(from_unit), self.get_unit(to_unit)
+        if from_unit.category_id != to_unit.category_id:
+            raise IncompatibleUnits("Can not convert {} into {}".format(from_unit.label, to_unit.label))
+        return self.get_matrix(from_unit.category_id).factor(from_unit.pk, to_unit.pk)
+
+    def convert(self, value, from_unit, to_unit):
+        """Convert a single amount"""
+        return value * self.get_factor(from_unit, to_unit)
+
+    def convert_many(self, values, from_unit, to_unit):
+        """
+        Convert a sequence of amounts expressed in the same unit.
+
+        Returns a NumPy array when NumPy is installed, a list otherwise.
+        """
+        factor = self.get_factor(from_unit, to_unit)
+        if numpy is not None:
+            return numpy.asarray(values, dtype=float) * factor
+        return [value * factor for value in values]
+
+    def convert_mixed(self, values, from_units, to_unit):
+        """
+        Convert amounts each expressed in its own unit (Unit or primary key).
+
+        All units must belong to the category of to_unit. With NumPy, factors
+        are gathered from the matrix with one vectorized lookup.
+        """
+        to_unit = self.get_unit(to_unit)
+        matrix = self.get_matrix(to_unit.category_id)
+        target = matrix.index[to_unit.pk]
+        if numpy is None or not isinstance(from_units, numpy.ndarray):
+            # Arrays are taken as primary keys, without a loop
+            from_units = [self.get_unit_pk(unit) for unit in from_units]
+        if numpy is None:
+            try:
+                return [value * matrix.factors[matrix.index[unit]][target]
+                        for value, unit in zip(values, from_units)]
+            except KeyError as error:
+                raise IncompatibleUnits("Unit #{} can not be converted into {}".format(error.args[0], to_unit.label))
+        from_units = numpy.asarray(from_units)
+        positions = numpy.searchsorted(matrix.pks, from_units)
+        positions = numpy.clip(positions, 0, len(matrix.pks) - 1)
+        unknown = matrix.pks[positions] != from_units
+        if unknown.any():
+            raise IncompatibleUnits("Units {} can not be converted into {}".format(
+                sorted(set(from_units[unknown].tolist())), to_unit.label))
+        return numpy.asarray(values, dtype=float) * matrix.factors[positions, target]
+
+
+class RatePeriods:
+    """Rate periods of one currency, sorted by start"""
+
+    def __init__(self):
+        self.starts, self.ends, self.values = [], [], []
+
+    def append(self, start, end, value):
+        """Add the next period"""
+        self.starts.append(start)
+        self.ends.append(end)
+        self.values.append(value)
+
+    def rate_at(self, currency_id, date):
+        """Rate in effect at a date, periods being [start, end)"""
+        position = bisect_right(self.starts, date) - 1
+        if position < 0 or (self.ends[position] is not None and self.ends[position] <= date):
+            raise MissingRate("No rate for currency #{} at {}".format(currency_id, date))
+        return self.values[position]
+
+    def rates_at(self, currency_id, stamps):
+        """Rates in effect at an array of timestamps, with one sorted search"""
+        if not self.starts:
+            raise MissingRate("No rate for currency #{}".format(currency_id))
+        starts = numpy.array([start.timestamp() for start in self.starts])
+        ends = numpy.array([numpy.inf if end is None else end.timestamp() for end in self.ends])
+        positions = numpy.searchsorted(starts, stamps, side="right") - 1
+        missing = positions < 0
+        positions[missing] = 0
+        missing |= ends[positions] <= stamps
+        if missing.any():
+            raise MissingRate("No rate for currency #{} at {} dates".format(currency_id, missing.sum()))
+        return numpy.array(self.values, dtype=float)[positions]
+
+
+class CurrencyConverter:
+    """Convert amounts between currencies with the rates in effect at given dates"""
+
+    def get_periods(self, currency_ids, first, last):
+        """Rate periods of currencies overlapping [first, last], with one range query"""
+        periods = defaultdict(RatePeriods)
+        rates = (
+            CurrencyRate.time_framed_objects
+            .filter(currency__in=currency_ids, start__lte=last)
+            .filter(Q(end__gt=first) | Q(end__isnull=True))
+            .order_by("currency", "start")
+            .values_list("currency", "start", "end", "value")
+        )
+        for currency_id, start, end, value in rates:
+            periods[currency_id].append(start, end, value)
+        return periods
+
+    def get_rates(self, currency_ids, dates, periods):
+        """Rate of each (currency, date) pair"""
+        if numpy is None:
+            return [
+                periods[currency_id].rate_at(currency_id, date)
+                for currency_id, date in zip(currency_ids, dates)
+            ]
+        currency_ids = numpy.asarray(currency_ids)
+        stamps = numpy.array([date.timestamp() for date in dates])
+        rates = numpy.empty(len(stamps))
+        for currency_id in numpy.unique(currency_ids).tolist():
+            mask = currency_ids == currency_id
+            rates[mask] = periods[currency_id].rates_at(currency_id, stamps[mask])
+        return rates
+
+    def convert_many(self, amounts, currencies, dates, to_currency=None):
+        """
+        Convert amounts, each expressed in its currency at its date.
+
+        currencies are Currency objects or primary keys, dates are dates or
+        datetimes (see as_datetime). Amounts are converted into euros, or into
+        to_currency at the same dates. Rates are loaded with one query; returns
+        a NumPy array when NumPy is installed.
+        """
+        currency_ids = [
+            currency.pk if isinstance(currency, Currency) else currency
+            for currency in currencies
+        ]
+        dates = [as_datetime(date) for date in dates]
+        if not dates:
+            return numpy.array([]) if numpy is not None else []
+        wanted = set(currency_ids)
+        if to_currency is not None:
+            to_currency = to_currency.pk if isinstance(to_currency, Currency) else to_currency
+            wanted.add(to_currency)
+        periods = self.get_periods(wanted, min(dates), max(dates))
+        rates = self.get_rates(currency_ids, dates, periods)
+        if numpy is not None:
+            result = numpy.asarray(amounts, dtype=float) / rates
+            if to_currency is not None:
+                result *= self.get_rates([to_currency] * len(dates), dates, periods)
+            return result
+        result = [amount / rate for amount, rate in zip(amounts, rates)]
+        if to_currency is not None:
+            result = [
+                amount * rate
+                for amount, rate in zip(result, self.get_rates([to_currency] * len(dates), dates, periods))
+            ]
+        return result
+
+    def convert(self, amount, currency, date, to_currency=None):
+        """Convert a single amount"""
+        return self.convert_many([amount], [currency], [date], to_currency)[0]
+
+
+unit_converter = UnitConverter()  # pylint: disable=invalid-name
+currency_converter = CurrencyConverter()  # pylint: disable=invalid-name
@@ -2,8 +2,33 @@
 
 from django.db import models
 from django.db.models import ForeignKey
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
 
 from .models import Status
+from .registry import reference_registry, status_registry
+
+
+class ReferenceDescriptor(ForwardManyToOneDescriptor):
+    """Read the related object from the reference registry (a copy of its row)"""
+
+    def __get__(self, instance, cls=None):
+        if instance is None or self.field.is_cached(instance):
+            return super().__get__(instance, cls)
+        value = getattr(instance, self.field.attname)
+        if value is None:
+            return super().__get__(instance, cls)
+        try:
+            result = reference_registry.get(self.field.related_model, value)
+        except self.field.related_model.DoesNotExist:
+            return super().__get__(instance, cls)
+        self.field.set_cached_value(instance, result)
+        return result
+
+
+class ReferenceForeignKey(ForeignKey):
+    """A ForeignKey to reference data, resolved without query"""
+
+    forward_related_accessor_class = ReferenceDescriptor
 
 
 class StatusField(ForeignKey):
@@ -16,10 +41,19 @@ class StatusField(ForeignKey):
         super(StatusField, self).__init__(to, *args, **kwargs)
 
     def get_default(self):
-        """Get the default status"""
-        result = Status.objects.filter(model=self.status_related_model,
-                                       is_default=True).first()
-        return result and result.id or None
+        """Get the default status (from the process wide registry)"""
+        return status_registry.get_default_id(self.status_related_model)
+
+    def formfield(self, **kwargs):
+        """Dropdown fed by the status registry"""
+        if getattr(self, "status_related_model", None) is None:
+            return super(StatusField, self).formfield(**kwargs)
+        from .forms import StatusChoiceField  # pylint: disable=import-outside-toplevel
+        return super(StatusField, self).formfield(**{
+            "form_class": StatusChoiceField,
+            "status_model": self.status_related_model,
+            **kwargs,
+        })
 
     def prepare_class(self, sender, **kwargs):  # pylint: disable=unused-argument
         """Mandatory method: Allow to update the field on the fly to adapt it to the model"""
@@ -1 +1,44 @@
-"""TODO"""
+"""Form fields"""
+
+from django.core.exceptions import ValidationError
+from django.forms.models import ModelChoiceField, ModelChoiceIterator
+
+from .models import Status
+from .registry import status_registry
+
+
+class StatusChoiceIterator(ModelChoiceIterator):
+    """Iterate over the statuses of a model, from the registry"""
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for status in status_registry.get_statuses(self.field.status_model):
+            yield self.choice(status)
+
+    def __len__(self):
+        return (len(status_registry.get_statuses(self.field.status_model)) +
+                (1 if self.field.empty_label is not None else 0))
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(len(self))
+
+
+class StatusChoiceField(ModelChoiceField):
+    """Status dropdown built and validated without querying the database"""
+
+    iterator = StatusChoiceIterator
+
+    def __init__(self, queryset, *args, status_model, **kwargs):
+        self.status_model = status_model
+        super().__init__(queryset, *args, **kwargs)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        if isinstance(value, Status):
+            value = value.pk
+        try:
+            return status_registry.get_by_pk(self.status_model, int(value))
+        except (ValueError, TypeError, Status.DoesNotExist):
+            raise ValidationError(self.error_messages["invalid_choice"], code="invalid_choice")
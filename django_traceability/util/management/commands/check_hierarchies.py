@@ -0,0 +1,68 @@
+"""Audit hierarchical tables for cycles and orphans"""
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from util.mixins import NaiveHierarchyMixin
+
+
+def find_orphans(parents):
+    """Nodes whose parent does not exist"""
+    return sorted(pk for pk, parent_id in parents.items() if parent_id is not None and parent_id not in parents)
+
+
+def find_cycles(parents):
+    """Cycles of a parent mapping, each one as a list of primary keys"""
+    cycles = []
+    done = set()
+    for start in parents:
+        path, positions = [], {}
+        node = start
+        while node in parents and node not in done and node not in positions:
+            positions[node] = len(path)
+            path.append(node)
+            node = parents[node]
+        if node in positions:
+            cycles.append(path[positions[node]:])
+        done.update(path)
+    return cycles
+
+
+class Command(BaseCommand):
+    """Scan hierarchies in one pass per table"""
+
+    help = "Find cycles and orphans in the tables of models using NaiveHierarchyMixin."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "models", nargs="*", metavar="app_label.ModelName",
+            help="Models to check (all hierarchical models by default).",
+        )
+
+    def get_models(self, labels):
+        """Models to check"""
+        if labels:
+            models = [apps.get_model(label) for label in labels]
+            for model in models:
+                if not issubclass(model, NaiveHierarchyMixin):
+                    raise CommandError("{} is not a hierarchical model.".format(model._meta.label))
+            return models
+        return [model for model in apps.get_models() if issubclass(model, NaiveHierarchyMixin)]
+
+    def handle(self, *args, **options):
+        errors = 0
+        for model in self.get_models(options["models"]):
+            parents = dict(model._base_manager.values_list("pk", "parent").iterator())
+            orphans = find_orphans(parents)
+            cycles = find_cycles(parents)
+            label = model._meta.label
+            if not orphans and not cycles:
+                self.stdout.write("{}: {} nodes, OK".format(label, len(parents)))
+                continue
+            errors += len(orphans) + len(cycles)
+            if orphans:
+                self.stdout.write(self.style.ERROR("{}: orphans {}".format(label, orphans)))
+            for cycle in cycles:
+                self.stdout.write(self.style.ERROR("{}: cycle {}".format(label, " -> ".join(map(str, cycle)))))
+        if errors:
+            raise CommandError("{} problem(s) found.".format(errors))
@@ -0,0 +1,182 @@
+"""Load ISO reference data (countries, states, currencies, units...)"""
+
+import csv
+import json
+from collections import namedtuple
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from util.models import (
+    Country,
+    StateCategory,
+    State,
+    Locale,
+    TimeZone,
+    UnitCategory,
+    Unit,
+    Currency,
+)
+from util.registry import reference_registry
+
+FIXTURES = Path(__file__).resolve().parents[2] / "fixtures"
+
+# keys: natural key used to upsert rows
+# aliases: renamed columns, for fixtures naming a lookup differently
+Source = namedtuple("Source", ("model", "keys", "aliases"))
+
+# Sources, in dependency order, indexed by file name (without extension)
+SOURCES = {
+    "countries": Source(Country, ("alpha2",), {}),
+    "state_categories": Source(StateCategory, ("label",), {}),
+    "states": Source(State, ("code",), {"category__name": "category__label"}),
+    "currencies": Source(Currency, ("iso_code",), {}),
+    "unit_categories": Source(UnitCategory, ("label",), {}),
+    "units": Source(Unit, ("category", "label"), {"category__name": "category__label"}),
+    "locales": Source(Locale, ("label",), {}),
+    "timezones": Source(TimeZone, ("label",), {}),
+}
+
+
+def read_rows(path):
+    """Stream rows (dicts) from a CSV, JSON or JSON lines file"""
+    with path.open(encoding="utf-8", newline="") as stream:
+        if path.suffix == ".csv":
+            reader = csv.DictReader(stream)
+            for row in reader:
+                if None in row or None in row.values():
+                    raise CommandError("{}, line {}: malformed row".format(path.name, reader.line_num))
+                yield row
+        elif path.suffix == ".jsonl":
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+        elif path.suffix == ".json":
+            yield from json.load(stream)
+        else:
+            raise CommandError("Unsupported file format: {}".format(path))
+
+
+def batches(iterable, size):
+    """Split an iterable into lists of at most size items"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Loader:
+    """Upsert the rows of one source, resolving foreign keys from memory"""
+
+    def __init__(self, source, batch_size):
+        self.source = source
+        self.model = source.model
+        self.batch_size = batch_size
+        self._lookups = {}
+        self.created = self.updated = 0
+
+    def get_lookup(self, model, field):
+        """Map {field value: primary key} of a related model, loaded once"""
+        if (model, field) not in self._lookups:
+            self._lookups[model, field] = dict(model._base_manager.values_list(field, "pk"))
+        return self._lookups[model, field]
+
+    def convert(self, row):
+        """Turn a raw row into {attname: python value}"""
+        result = {}
+        for column, value in row.items():
+            column = self.source.aliases.get(column, column)
+            name, _sep, lookup = column.partition("__")
+            field = self.model._meta.get_field(name)
+            if value == "" and field.null:
+                value = None
+            if lookup:
+                try:
+                    value = self.get_lookup(field.related_model, lookup)[value]
+                except KeyError:
+                    raise CommandError("{}: unknown {} {!r}".format(
+                        self.model._meta.label, column, value))
+                result[field.attname] = value
+            else:
+                result[field.attname] = field.to_python(value)
+        return result
+
+    def key(self, values):
+        """Natural key of a row"""
+        return tuple(values[self.model._meta.get_field(name).attname] for name in self.source.keys)
+
+    @property
+    def key_attnames(self):
+        """Attribute names of the natural key"""
+        return tuple(self.model._meta.get_field(name).attname for name in self.source.keys)
+
+    def load(self, rows):
+        """Create missing rows and update changed ones, batch by batch"""
+        existing = update_columns = None
+        for batch in batches((self.convert(row) for row in rows), self.batch_size):
+            if existing is None:
+                columns = list(batch[0])
+                update_columns = [column for column in columns if column not in self.key_attnames]
+                existing = {
+                    self.key(values): values
+                    for values in self.model._base_manager.values("pk", *columns).iterator()
+                }
+            self.flush(batch, existing, update_columns)
+
+    def flush(self, rows, existing, update_columns):
+        """Upsert a batch of rows"""
+        to_create, to_update = [], []
+        for values in rows:
+            current = existing.get(self.key(values))
+            if current is None:
+                to_create.append(self.model(**values))
+            elif any(current[column] != values[column] for column in update_columns):
+                to_update.append(self.model(pk=current["pk"], **values))
+        if to_create:
+            self.model._base_manager.bulk_create(to_create)
+        if to_update and update_columns:
+            self.model._base_manager.bulk_update(to_update, update_columns)
+        self.created += len(to_create)
+        self.updated += len(to_update)
+
+
+class Command(BaseCommand):
+    """Bulk upsert of reference data"""
+
+    help = ("Load reference data from CSV, JSON or JSON lines files named after their content "
+            "(countries, state_categories, states, currencies, unit_categories, units, locales, "
+            "timezones). Existing rows are matched on their natural key and updated.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "files", nargs="*",
+            help="Files to load (util fixtures by default).",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Number of rows read and written at once.",
+        )
+
+    def get_files(self, names):
+        """Files to load, sorted in dependency order"""
+        files = [Path(name) for name in names] or sorted(FIXTURES.glob("*.csv"))
+        for path in files:
+            if path.stem not in SOURCES:
+                raise CommandError("Unknown reference data: {}".format(path.name))
+        order = list(SOURCES)
+        return sorted(files, key=lambda path: order.index(path.stem))
+
+    def handle(self, *args, **options):
+        for path in self.get_files(options["files"]):
+            source = SOURCES[path.stem]
+            loader = Loader(source, options["batch_size"])
+            with transaction.atomic():
+                loader.load(read_rows(path))
+            if source.model in reference_registry.models:
+                reference_registry.invalidate(source.model)
+            self.stdout.write("{}: {} created, {} updated".format(path.name, loader.created, loader.updated))
@@ -0,0 +1,66 @@
+"""Rebuild status counters from scratch"""
+
+from collections import Counter
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from util.mixins import StatusMixin
+from util.models import StatusCounter
+
+
+def count_statuses(queryset, chunk_size):
+    """Count objects per status, one GROUP BY per chunk of primary keys"""
+    counts = Counter()
+    queryset = queryset.order_by("pk")
+    lower = None
+    while True:
+        chunk = queryset if lower is None else queryset.filter(pk__gt=lower)
+        upper = chunk.values_list("pk", flat=True)[chunk_size - 1:chunk_size].first()
+        if upper is not None:
+            chunk = chunk.filter(pk__lte=upper)
+        counts.update(dict(chunk.order_by().values_list("status").annotate(Count("pk"))))
+        if upper is None:
+            return counts
+        lower = upper
+
+
+class Command(BaseCommand):
+    """Recount objects per status for models enabling count_statuses"""
+
+    help = "Rebuild the StatusCounter rows of models using StatusMixin with count_statuses."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "models", nargs="*", metavar="app_label.ModelName",
+            help="Models to recount (all models counting statuses by default).",
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=50000,
+            help="Number of rows aggregated by each query.",
+        )
+
+    def get_models(self, labels):
+        """Models owning a status field and counting statuses"""
+        if labels:
+            models = [apps.get_model(label) for label in labels]
+        else:
+            models = apps.get_models()
+        models = [model for model in models if issubclass(model, StatusMixin) and model.count_statuses]
+        if labels and len(models) != len(labels):
+            raise CommandError("Some models do not count statuses.")
+        return [model for model in models if model._meta.get_field("status").model is model]
+
+    def handle(self, *args, **options):
+        for model in self.get_models(options["models"]):
+            label = model.get_status_model()
+            counts = count_statuses(model._base_manager.all(), options["chunk_size"])
+            with transaction.atomic():
+                StatusCounter.objects.filter(model=label).delete()
+                StatusCounter.objects.bulk_create(
+                    StatusCounter(model=label, status_id=status_id, count=count)
+                    for status_id, count in counts.items()
+                )
+            self.stdout.write("{}: {} objects in {} statuses".format(label, sum(counts.values()), len(counts)))
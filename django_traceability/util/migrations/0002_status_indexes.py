@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('util', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='status',
+            index=models.Index(fields=['model', 'is_default'], name='util_status_model_default_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='status',
+            index=models.Index(fields=['model', 'label'], name='util_status_model_label_idx'),
+        ),
+    ]
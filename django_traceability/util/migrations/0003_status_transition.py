@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:29
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('util', '0002_status_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatusTransition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(help_text='Model of the changed object', max_length=64, verbose_name='model')),
+                ('object_id', models.PositiveIntegerField(help_text='Primary key of the changed object', verbose_name='object id')),
+                ('date', models.DateTimeField(default=django.utils.timezone.now, help_text='When the status changed', verbose_name='date')),
+                ('actor', models.ForeignKey(blank=True, help_text='Who changed the status', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='status_transition_set', to=settings.AUTH_USER_MODEL, verbose_name='actor')),
+                ('from_status', models.ForeignKey(help_text='Status before the change', on_delete=django.db.models.deletion.PROTECT, related_name='transition_from_set', to='util.Status', verbose_name='from status')),
+                ('to_status', models.ForeignKey(help_text='Status after the change', on_delete=django.db.models.deletion.PROTECT, related_name='transition_to_set', to='util.Status', verbose_name='to status')),
+            ],
+            options={
+                'verbose_name': 'status transition',
+                'verbose_name_plural': 'status transitions',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='statustransition',
+            index=models.Index(fields=['model', 'object_id'], name='util_transition_object_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('util', '0003_status_transition'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatusCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(db_index=True, help_text='Model related to the status', max_length=64, verbose_name='model')),
+                ('count', models.IntegerField(default=0, help_text='Number of objects in this status', verbose_name='count')),
+                ('status', models.OneToOneField(help_text='Counted status', on_delete=django.db.models.deletion.CASCADE, related_name='counter', to='util.Status', verbose_name='status')),
+            ],
+            options={
+                'verbose_name': 'status counter',
+                'verbose_name_plural': 'status counters',
+            },
+        ),
+    ]
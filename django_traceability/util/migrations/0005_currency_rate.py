@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('util', '0004_status_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrencyRate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(verbose_name='start on')),
+                ('end', models.DateTimeField(blank=True, null=True, verbose_name='end on')),
+                ('value', models.FloatField(help_text='amount to 1 euros', verbose_name='value')),
+                ('currency', models.ForeignKey(help_text='Currency this rate applies to', on_delete=django.db.models.deletion.CASCADE, related_name='util_currencyrate_set', to='util.Currency', verbose_name='currency')),
+            ],
+            options={
+                'verbose_name': 'currency rate',
+                'verbose_name_plural': 'currency rates',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='currencyrate',
+            index=models.Index(fields=['currency', 'start'], name='util_rate_currency_start_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:36
+
+from django.db import migrations, models
+import util.timeframe
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('util', '0005_currency_rate'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='currencyrate',
+            index=models.Index(fields=['end', 'start'], name='util_curren_end_aef493_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='currencyrate',
+            index=util.timeframe.ConditionalIndex(condition=models.Q(end__isnull=True), fields=['start'], name='util_currencyr_c7824559_open'),
+        ),
+    ]
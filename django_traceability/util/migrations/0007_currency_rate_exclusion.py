@@ -0,0 +1,18 @@
+from django.db import migrations
+
+import util.timeframe
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('util', '0006_currency_rate_period_indexes'),
+    ]
+
+    operations = [
+        util.timeframe.AddPeriodExclusionConstraint(
+            model_name='currencyrate',
+            fields=['currency'],
+            name='util_rate_no_overlap',
+        ),
+    ]
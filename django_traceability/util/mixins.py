@@ -1,18 +1,37 @@
 """TODO"""
 
+from collections import Counter, defaultdict
 from pathlib import Path
 from uuid import uuid4
 
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import ValidationError
+from django.db import connections, router, transaction
 from django.db.models import (
+    signals,
     QuerySet,
     Model,
-    DateTimeField,
     CharField,
+    TextField,
+    IntegerField,
     ForeignKey,
     PositiveSmallIntegerField,
     ImageField,
     Q,
+    F,
+    Value,
+    Count,
+    Exists,
+    OuterRef,
+    Subquery,
+    Max,
+    Case,
+    When,
     CASCADE, PROTECT)
+from django.db.models.expressions import RawSQL
+from django.db.models.query import ModelIterable
+from django.dispatch import receiver
+from django.db.models.functions import Coalesce, Concat, Length, Substr
 
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import now
@@ -21,106 +40,263 @@ from django.db.models import (
     Manager,
 )
 
-from util.models import State, Country, Locale, TimeZone
+from util.models import State, Country, Locale, TimeZone, Status, StatusCounter, StatusTransition
 
-from .fields import StatusField
+from .cache import bump_tree_version, cached_traversal
+from .fields import ReferenceForeignKey, StatusField
+from .registry import status_registry
+from .timeframe import TimeFramedQuerySet, TimeFramedManager, TimeFramedMixin  # noqa: F401
+from .tree import Tree
 
 
-class TimeFramedQuerySet(QuerySet):
-    """QuerySet used by BaseMixin models"""
+class RecursiveSQL(RawSQL):
+    """Raw recursive query, usable as the right hand side of an __in lookup"""
 
-    def in_effect(self):
-        """Allow to find an object that is currently valid"""
-        current_date = now()
-        return self.filter(
-            Q(start__lte=current_date) & (
-                Q(end__gte=current_date) | Q(end__isnull=True)
-            )
-        )
+    def as_sql(self, compiler, connection):
+        # RawSQL adds its own parentheses, that the lookup already provides.
+        return self.sql, self.params
 
-    def in_effect_at(self, date):
-        """Allow to find an object that is valid at a specific date"""
-        return self.filter(
-            Q(start__lte=date) & (
-                Q(end__gt=date) | Q(end__isnull=True)
-            )
-        )
 
+# Recursive queries are written with the UNION operator (not UNION ALL), so
+# that they stop even when the stored hierarchy contains a cycle.
+DESCENDANTS_SQL = """
+WITH RECURSIVE subtree(node_id) AS (
+    SELECT {pk} FROM {table} WHERE {parent} IN ({anchors})
+    UNION
+    SELECT {table}.{pk} FROM {table} INNER JOIN subtree ON {table}.{parent} = subtree.node_id
+)
+SELECT node_id FROM subtree
+"""
+
+# Ancestors carry their level (1 for the parent), used to sort them from the
+# root. As levels differ, UNION can not stop on a cycle: the number of rows
+# of the table bounds the recursion instead.
+LINEAGE_SQL = """
+WITH RECURSIVE lineage(node_id, parent_id, level) AS (
+    SELECT {pk}, {parent}, 1 FROM {table} WHERE {pk} IN ({anchors})
+    UNION
+    SELECT {table}.{pk}, {table}.{parent}, lineage.level + 1
+    FROM {table} INNER JOIN lineage ON {table}.{pk} = lineage.parent_id
+    WHERE lineage.level < (SELECT COUNT(*) FROM {table})
+)
+"""
 
-class TimeFramedManager(Manager):
-    """Manager for Models using the Time Framed Mixin"""
+ANCESTORS_SQL = LINEAGE_SQL + "SELECT node_id FROM lineage"
 
-    def _get_queryset(self):
-        """Link to the query set"""
-        return TimeFramedQuerySet(self.model, using=self._db)
+ANCESTOR_LEVEL_SQL = LINEAGE_SQL + "SELECT MAX(level) FROM lineage WHERE node_id = {table}.{pk}"
 
-    def get_queryset(self):
-        """Return the query set"""
-        return self._get_queryset()
 
-    @property
-    def in_effect(self):
-        """Get only active objects"""
-        return self.get_queryset().in_effect()
+# Nodes reachable from a root, parents first: used to rebuild materialized
+# paths. Nodes caught in a cycle are never reached, so this always stops.
+ROOTED_SQL = """
+WITH RECURSIVE rooted(node_id, parent_id, path, depth) AS (
+    SELECT {pk}, {parent}, {path}, 0 FROM {table} WHERE {parent} IS NULL
+    UNION ALL
+    SELECT {table}.{pk}, {table}.{parent}, {table}.{path}, rooted.depth + 1
+    FROM {table} INNER JOIN rooted ON {table}.{parent} = rooted.node_id
+)
+SELECT node_id, parent_id, path FROM rooted ORDER BY depth
+"""
 
-    def in_effect_at(self, date):
-        """Get only active objects"""
-        return self.get_queryset().in_effect_at(date)
 
+# Stored parent of a node that was not loaded from the database
+_UNKNOWN = object()
 
-class TimeFramedMixin(Model):
-    """Must be inherited by models that are valid only in a period of time"""
 
-    #
-    # Embedded QuerySet
-    #
+def _prune_filtered_descendants(node, candidates):
+    """Keep only candidates linked to node through other candidates"""
+    by_parent = defaultdict(list)
+    for candidate in candidates:
+        by_parent[candidate.parent_id].append(candidate)
+    result, pending = set(), [node.pk]
+    while pending:
+        children = by_parent.pop(pending.pop(), ())
+        result.update(children)
+        pending.extend(child.pk for child in children)
+    return result
 
-    class QuerySet(TimeFramedQuerySet):
-        """Base QuerySet used by BaseMixin models that does not overwrite it"""
 
-    # same default filters as BaseManager, with some other filters added
-    time_framed_objects = TimeFramedManager()
+class RootFiltersIterable(ModelIterable):
+    """Yield objects remembering the root filters of their QuerySet"""
 
-    #
-    # Define valid period
-    #
+    def __iter__(self):
+        root_filters = self.queryset.root_filters
+        for obj in super().__iter__():
+            obj._root_filters = root_filters  # pylint: disable=protected-access
+            yield obj
 
-    start = DateTimeField(
-        verbose_name=_("start on"),
-        blank=False,
-        editable=True,  # TODO: Think about that
-    )
 
-    end = DateTimeField(
-        verbose_name=_("end on"),
-        null=True,
-        blank=True,
-        editable=True,  # TODO: Think about that
-    )
+class NaiveHierarchyQuerySet(QuerySet):
+    """
+    QuerySet used by NaiveHierarchyMixin models.
 
-    class Meta:  # pylint: disable=too-few-public-methods
-        """TimeFramedMixin Meta class"""
+    Filters used to find roots are carried by the QuerySet, its clones and
+    the objects it returns, never by the manager that is shared by all the
+    threads, so concurrent requests can not mix their filters.
+    """
 
-        abstract = True
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.root_filters = {}
+        self._iterable_class = RootFiltersIterable
+
+    def _clone(self):
+        """Keep root filters on the clone"""
+        clone = super()._clone()
+        clone.root_filters = self.root_filters
+        return clone
+
+    def with_root_filters(self, root_filters):
+        """Propagate root filters to the objects found by this QuerySet"""
+        clone = self._chain()
+        clone.root_filters = dict(root_filters)
+        return clone
+
+    def _children_of_outer_node(self, use_root_filters):
+        """Children of the node of the outer query, as a subquery"""
+        result = self.model.tree.filter(parent=OuterRef("pk"))
+        if use_root_filters and self.root_filters:
+            result = result.filter(**self.root_filters)
+        return result
+
+    def with_has_children(self, *, use_root_filters=True):
+        """
+        Annotate whether each node has children, in the same query.
+
+        Annotates filtered_children_exist, or children_exist when root filters
+        are not used, which has_filtered_children() / has_children() read.
+        """
+        name = "filtered_children_exist" if use_root_filters else "children_exist"
+        return self.annotate(**{name: Exists(self._children_of_outer_node(use_root_filters))})
+
+    def with_child_count(self, *, use_root_filters=True):
+        """
+        Annotate the number of children of each node, in the same query.
+
+        Annotates filtered_child_count, or child_count when root filters are
+        not used.
+        """
+        name = "filtered_child_count" if use_root_filters else "child_count"
+        counts = (self._children_of_outer_node(use_root_filters)
+                  .order_by()
+                  .values("parent")
+                  .annotate(count=Count("pk", distinct=True))
+                  .values("count"))
+        return self.annotate(**{name: Coalesce(Subquery(counts, output_field=IntegerField()), 0)})
+
+    def update(self, **kwargs):
+        """Update the rows, then invalidate cached traversals (no signal is sent)"""
+        rows = super().update(**kwargs)
+        self.model.invalidate_hierarchy_cache(using=self.db)
+        return rows
 
 
 class NaiveHierarchyManager(Manager):
     """Manager for Naive Hierarchy Mixin"""
 
-    def __init__(self):
-        super().__init__()
-        self.root_filters = {}
+    def get_queryset(self):
+        """Return the query set"""
+        return NaiveHierarchyQuerySet(self.model, using=self._db)
+
+    def _get_tree_queryset(self, node):
+        """QuerySet propagating the root filters the node was reached with"""
+        return self.get_queryset().with_root_filters(node.root_filters)
 
     def get_roots(self, **kwargs):
         """Returns only first level objects"""
-        self.root_filters = kwargs
-        return self.get_queryset().filter(parent__isnull=True).filter(**kwargs)
+        return self.get_queryset().with_root_filters(kwargs).filter(parent__isnull=True).filter(**kwargs)
 
     def get_children(self, node, *, use_root_filters=False):
         """Allow to get children propagating filters or not"""
-        result = self.get_queryset().filter(parent=node)
-        if use_root_filters and self.root_filters:
-            result = result.filter(**self.root_filters)
+        result = self._get_tree_queryset(node).filter(parent=node)
+        if use_root_filters and node.root_filters:
+            result = result.filter(**node.root_filters)
+        return result
+
+    def load_tree(self, *fields, **root_filters):
+        """
+        Load the whole hierarchy in memory with one streaming query.
+
+        Only the primary key, the parent and the given fields are fetched.
+        Root filters apply to every node, as for get_filtered_children().
+        """
+        def compute():
+            rows = (self.get_queryset()
+                    .filter(**root_filters)
+                    .distinct()
+                    .values_list("pk", "parent", *fields)
+                    .iterator())
+            return Tree(fields, rows)
+
+        return self.model.cached_traversal(("load_tree", fields, sorted(root_filters.items())), compute)
+
+    def _format_recursive_sql(self, sql, node_ids):
+        """Fill a recursive query template for this model and these anchors"""
+        quote_name = connections[self.db].ops.quote_name
+        opts = self.model._meta
+        return sql.format(
+            table=quote_name(opts.db_table),
+            pk=quote_name(opts.pk.column),
+            parent=quote_name(opts.get_field("parent").column),
+            anchors=", ".join(["%s"] * len(node_ids)),
+        )
+
+    def _recursive_query(self, queryset, sql, node_ids):
+        """Restrict a QuerySet to the primary keys returned by a recursive query"""
+        node_ids = list(node_ids)
+        if not node_ids:
+            return queryset.none()
+        return queryset.filter(pk__in=RecursiveSQL(self._format_recursive_sql(sql, node_ids), node_ids))
+
+    def descendants_of(self, node):
+        """All descendants of a node, as a lazy QuerySet (WITH RECURSIVE)"""
+        return self._recursive_query(self._get_tree_queryset(node), DESCENDANTS_SQL, [node.pk])
+
+    def subtree_of(self, node):
+        """The node and all its descendants, as a lazy QuerySet"""
+        return self.descendants_of(node) | self._get_tree_queryset(node).filter(pk=node.pk)
+
+    def ancestors_of(self, node):
+        """All ancestors of a node, from the root to the parent, as a lazy QuerySet (WITH RECURSIVE)"""
+        if node.parent_id is None:
+            return self._get_tree_queryset(node).none()
+        anchors = [node.parent_id]
+        level = RawSQL(self._format_recursive_sql(ANCESTOR_LEVEL_SQL, anchors), anchors, output_field=IntegerField())
+        return self._recursive_query(self._get_tree_queryset(node), ANCESTORS_SQL, anchors).order_by(level.desc())
+
+    def _ancestors_of_many(self, nodes):
+        """All ancestors of several nodes, fetched with a single query"""
+        return self._recursive_query(
+            self.get_queryset(), ANCESTORS_SQL, {node.parent_id for node in nodes if node.parent_id is not None}
+        )
+
+    def resolve_paths(self, nodes, *, as_string=False, separator=" / "):
+        """
+        Compute the unique model path of many nodes at once.
+
+        All the ancestors are fetched with a single query, then paths are
+        built in memory. Returns a dict mapping each node primary key to the
+        tuple of objects from the root to the node, or to the string made
+        of those objects when as_string is True.
+        """
+        nodes = list(nodes)
+        known = {ancestor.pk: ancestor for ancestor in self._ancestors_of_many(nodes)}
+        known.update((node.pk, node) for node in nodes)
+        paths = {}
+        for node in nodes:
+            chain, seen, current = [], set(), node
+            # Walk up until a root, an already resolved node or a cycle
+            while current is not None and current.pk not in paths and current.pk not in seen:
+                chain.append(current)
+                seen.add(current.pk)
+                current = known.get(current.parent_id)
+            path = paths.get(current.pk, ()) if current is not None else ()
+            for item in reversed(chain):
+                path += (item,)
+                paths[item.pk] = path
+        result = {node.pk: paths[node.pk] for node in nodes}
+        if as_string:
+            return {pk: separator.join(str(item) for item in path) for pk, path in result.items()}
         return result
 
 
@@ -140,6 +316,13 @@ class NaiveHierarchyMixin(Model):
     tree = NaiveHierarchyManager()
     # objects = tree  # FIXME: Is this bug fix is relevant ?
 
+    # Opt-in cache of traversals (descendants, unique paths, loaded trees),
+    # invalidated as a whole by any save, delete or QuerySet.update() in the
+    # hierarchy. Other bulk writes (bulk_create, raw SQL...) must call
+    # invalidate_hierarchy_cache().
+    cache_hierarchy = False
+    hierarchy_cache_timeout = DEFAULT_TIMEOUT
+
     def get_children(self,):
         """Get children , whatever the filter used to find roots are"""
         return type(self).tree.get_children(self, use_root_filters=False).distinct()
@@ -150,37 +333,146 @@ class NaiveHierarchyMixin(Model):
 
     def has_children(self):
         """Has children , whatever the filter used to find roots are"""
-        return type(self).tree.get_children(self, use_root_filters=False).count() > 0
+        if hasattr(self, "children_exist"):
+            return self.children_exist
+        if hasattr(self, "child_count"):
+            return self.child_count > 0
+        return type(self).tree.get_children(self, use_root_filters=False).exists()
 
     def has_filtered_children(self):
         """Has children matching filters"""
-        return type(self).tree.get_children(self, use_root_filters=True).count() > 0
+        if hasattr(self, "filtered_children_exist"):
+            return self.filtered_children_exist
+        if hasattr(self, "filtered_child_count"):
+            return self.filtered_child_count > 0
+        return type(self).tree.get_children(self, use_root_filters=True).exists()
+
+    @property
+    def root_filters(self):
+        """Filters used to find the roots this node was reached from"""
+        return getattr(self, "_root_filters", {})
+
+    def get_ancestors(self):
+        """Get all ancestors"""
+        return type(self).tree.ancestors_of(self)
+
+    @classmethod
+    def cached_traversal(cls, parts, compute):
+        """Cache a traversal result when the model enables hierarchy caching"""
+        if not cls.cache_hierarchy:
+            return compute()
+        return cached_traversal(cls, parts, compute, cls.hierarchy_cache_timeout)
+
+    @classmethod
+    def invalidate_hierarchy_cache(cls, using=None):
+        """Invalidate all cached traversals now, and again once committed"""
+        if cls.cache_hierarchy:
+            # Other transactions may cache the old rows until the commit
+            bump_tree_version(cls)
+            transaction.on_commit(lambda: bump_tree_version(cls), using=using)
 
     def get_descendants(self):
         """Get all descendant, whatever the filter used to find roots are"""
-        result = set(self.get_children())
-        for node in list(result):
-            result.update(node.get_descendants())
-        return result
+        return self.cached_traversal(
+            ("descendants", self.pk),
+            lambda: set(type(self).tree.descendants_of(self)),
+        )
 
     def get_filtered_descendants(self):
         """Get descendant while propagate filters"""
-        result = set(self.get_filtered_children())
-        for node in list(result):
-            result.update(node.get_filtered_descendants())
-        return result
+        def compute():
+            candidates = type(self).tree.descendants_of(self).filter(**self.root_filters).distinct()
+            return _prune_filtered_descendants(self, candidates)
+
+        return self.cached_traversal(("filtered_descendants", self.pk, sorted(self.root_filters.items())), compute)
 
     @classmethod
     def get_roots(cls, **kwargs):
         """Returns first level objetcs"""
         return cls.tree.get_roots(**kwargs)
 
+    def _is_ancestor_of(self, node):
+        """Whether this node is an ancestor of another one (single query)"""
+        return type(self).tree.ancestors_of(node).filter(pk=self.pk).exists()
+
+    def check_new_parent(self, new_parent):
+        """Ensure that the node would not become its own ancestor"""
+        if new_parent is None or self.pk is None:
+            return
+        if new_parent.pk == self.pk or self._is_ancestor_of(new_parent):
+            raise ValidationError(
+                {"parent": _("A node can not be moved under itself or one of its descendants.")},
+                code="cycle",
+            )
+
+    def clean(self):
+        """Validate that the parent does not create a cycle"""
+        super().clean()
+        self.check_new_parent(self.parent)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remember the stored parent, to only check cycles when it changes"""
+        instance = super().from_db(db, field_names, values)
+        instance._stored_parent_id = instance.__dict__.get("parent_id", _UNKNOWN)
+        return instance
+
+    def save(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Refuse to save a node under itself or one of its descendants"""
+        if self.parent_id != getattr(self, "_stored_parent_id", _UNKNOWN):
+            self.check_new_parent(self.parent)
+        super().save(*args, **kwargs)
+        self._stored_parent_id = self.parent_id
+
+    def move_subtree(self, new_parent):
+        """
+        Move the node, and so its whole subtree, under a new parent.
+
+        The number of statements does not depend on the size of the subtree.
+        """
+        using = router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            self.parent = new_parent
+            self.save(using=using, update_fields=["parent"])
+
+    @classmethod
+    def _can_raw_delete(cls):
+        """Whether rows can be deleted without Django collecting related objects"""
+        opts = cls._meta
+        parent = opts.get_field("parent")
+        return not (
+            opts.parents or opts.many_to_many or opts.private_fields or
+            any(related.field is not parent for related in opts.related_objects) or
+            signals.pre_delete.has_listeners(cls) or signals.post_delete.has_listeners(cls)
+        )
+
+    def delete_subtree(self):
+        """
+        Delete the node and its whole subtree.
+
+        When nothing else references the model and no delete signal is
+        listened (cache_hierarchy listens to them), rows are removed by a
+        single DELETE statement. Otherwise
+        Django's collector handles cascades, one query per relation. With
+        materialized paths, a node without path is refused (ValueError)
+        before anything is deleted.
+        """
+        using = router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            subtree = type(self).tree.db_manager(using).subtree_of(self)
+            if self._can_raw_delete():
+                deleted = subtree._raw_delete(using)  # pylint: disable=protected-access
+            else:
+                deleted, _rows_count = subtree.delete()
+            self.invalidate_hierarchy_cache(using=using)
+        return deleted
+
     def _name_unique_model_path(self):
         """The logical model path to get the current object in a unique way"""
-        if not self.parent:
-            return self,
-        else:
-            return self.parent._name_unique_model_path() + (self,)  # pylint: disable=protected-access
+        return self.cached_traversal(
+            ("unique_model_path", self.pk),
+            lambda: type(self).tree.resolve_paths([self])[self.pk],
+        )
 
     class Meta:  # pylint: disable=too-few-public-methods
         """NaiveHierarchyManager Meta class"""
@@ -188,9 +480,244 @@ class NaiveHierarchyMixin(Model):
         abstract = True
 
 
+def _invalidate_hierarchy(sender, using, **kwargs):  # pylint: disable=unused-argument
+    """A node was saved or deleted: invalidate cached traversals"""
+    sender.invalidate_hierarchy_cache(using=using)
+
+
+@receiver(signals.class_prepared)
+def _connect_hierarchy_cache(sender, **kwargs):  # pylint: disable=unused-argument
+    """Invalidate the cached traversals of the models enabling cache_hierarchy"""
+    if issubclass(sender, NaiveHierarchyMixin) and sender.cache_hierarchy and not sender._meta.abstract:
+        signals.post_save.connect(_invalidate_hierarchy, sender=sender)
+        signals.post_delete.connect(_invalidate_hierarchy, sender=sender)
+
+
+class MaterializedPathHierarchyManager(NaiveHierarchyManager):
+    """Manager for Materialized Path Hierarchy Mixin"""
+
+    def descendants_of(self, node):
+        """All descendants of a node, found with one indexed query"""
+        return self._get_tree_queryset(node).filter(path__startswith=node.get_path()).exclude(pk=node.pk)
+
+    def subtree_of(self, node):
+        """The node and all its descendants, found with one indexed query"""
+        return self._get_tree_queryset(node).filter(path__startswith=node.get_path())
+
+    def ancestors_of(self, node):
+        """All ancestors of a node, from the root to the parent"""
+        return self._get_tree_queryset(node).filter(pk__in=node.get_ancestor_ids()).order_by("depth")
+
+    def _ancestors_of_many(self, nodes):
+        """All ancestors of several nodes, read from their paths"""
+        return self.get_queryset().filter(pk__in={pk for node in nodes for pk in node.get_ancestor_ids()})
+
+    def rebuild_paths(self, batch_size=1000):
+        """
+        Recompute the path and depth of every node.
+
+        Must be run when a model opts in with existing rows, and after bulk
+        writes (bulk_create, QuerySet.update of parents...), which bypass
+        save(). Nodes are read with one recursive query; only changed rows
+        are written. Nodes caught in a cycle keep their path. Returns the
+        number of updated nodes.
+        """
+        model = self.model
+        opts = model._meta
+        quote_name = connections[self.db].ops.quote_name
+        sql = ROOTED_SQL.format(
+            table=quote_name(opts.db_table),
+            pk=quote_name(opts.pk.column),
+            parent=quote_name(opts.get_field("parent").column),
+            path=quote_name(opts.get_field("path").column),
+        )
+        paths, changed = {}, []
+        with transaction.atomic(using=self.db):
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(sql)
+                rows = cursor.fetchall()
+            for pk, parent_id, old_path in rows:
+                path = paths[pk] = "{}{}{}".format(paths.get(parent_id, ""), pk, model.PATH_SEPARATOR)
+                if path != old_path:
+                    model.check_path_length(len(path))
+                    changed.append(model(pk=pk, path=path, depth=path.count(model.PATH_SEPARATOR) - 1))
+            self.bulk_update(changed, ["path", "depth"], batch_size=batch_size)
+            model.invalidate_hierarchy_cache(using=self.db)
+        return len(changed)
+
+    def at_depth(self, depth):
+        """All nodes at a given depth (roots are at depth 0)"""
+        return self.get_queryset().filter(depth=depth)
+
+
+class MaterializedPathHierarchyMixin(NaiveHierarchyMixin):
+    """
+    Naive hierarchy storing the materialized path of each node (opt-in).
+
+    The path holds the primary keys from the root down to the node, each
+    followed by PATH_SEPARATOR. It is kept up to date on save, including when
+    the parent changes, so descendants, ancestors and depth are single
+    queries whatever the size of the tree.
+
+    Bulk writes bypass save(): run tree.rebuild_paths() after them, and when
+    a model with existing rows opts in. Path lookups refuse nodes without a
+    path rather than matching the whole table.
+
+    The path column holds 255 characters, which caps the depth of the tree
+    (about 36 levels with 6 digit primary keys): deeper nodes are refused
+    with a ValidationError.
+    """
+
+    PATH_SEPARATOR = "/"
+
+    path = CharField(
+        verbose_name=_("path"),
+        help_text=_("Primary keys from the root to this node"),
+        max_length=255,
+        db_index=True,
+        editable=False,
+        blank=True,
+        default="",
+    )
+
+    depth = PositiveSmallIntegerField(
+        verbose_name=_("depth"),
+        help_text=_("Number of ancestors"),
+        editable=False,
+        default=0,
+    )
+
+    tree = MaterializedPathHierarchyManager()
+
+    @classmethod
+    def check_path_length(cls, length):
+        """Ensure that a path of this length fits in the path column"""
+        if length > cls._meta.get_field("path").max_length:
+            raise ValidationError(
+                {"parent": _("The hierarchy is too deep to store the path of this node.")},
+                code="depth",
+            )
+
+    def get_path(self):
+        """The stored path, refusing nodes whose path was never computed"""
+        if not self.path:
+            raise ValueError(
+                "{} #{} has no materialized path: run {}.tree.rebuild_paths() after bulk writes.".format(
+                    self._meta.label, self.pk, self._meta.object_name))
+        return self.path
+
+    def _is_ancestor_of(self, node):
+        """Whether this node is an ancestor of another one, using the stored path"""
+        if not node.path:
+            return super()._is_ancestor_of(node)
+        segment = "{}{}".format(self.pk, self.PATH_SEPARATOR)
+        return type(self).tree.filter(
+            Q(path__startswith=segment) | Q(path__contains=self.PATH_SEPARATOR + segment),
+            pk=node.pk,
+        ).exists()
+
+    def get_ancestor_ids(self):
+        """Primary keys of the ancestors, read from the path"""
+        to_python = self._meta.pk.to_python
+        return [to_python(pk) for pk in self.get_path().split(self.PATH_SEPARATOR)[:-2]]
+
+    def save(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Save the node then keep its path, and its subtree ones, up to date"""
+        using = kwargs.get("using") or router.db_for_write(type(self), instance=self)
+        manager = type(self).tree.db_manager(using)
+        with transaction.atomic(using=using):
+            paths = dict(manager.filter(pk__in=[pk for pk in (self.pk, self.parent_id) if pk is not None])
+                         .values_list("pk", "path"))
+            old_path = paths.get(self.pk) if self.pk is not None else None
+            parent_path = paths.get(self.parent_id, "") if self.parent_id is not None else ""
+            if self.parent_id is not None and not parent_path:
+                raise ValueError("The parent of {} #{} has no materialized path: run {}.tree.rebuild_paths().".format(
+                    self._meta.label, self.pk, self._meta.object_name))
+            super().save(*args, **kwargs)
+            path = "{}{}{}".format(parent_path, self.pk, self.PATH_SEPARATOR)
+            depth = path.count(self.PATH_SEPARATOR) - 1
+            self.check_path_length(len(path))
+            if old_path and len(path) > len(old_path):
+                # The deepest descendant must still fit once moved
+                longest = manager.filter(path__startswith=old_path).aggregate(longest=Max(Length("path")))["longest"]
+                self.check_path_length(longest + len(path) - len(old_path))
+            if old_path and old_path != path:
+                manager.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                    path=Concat(Value(path), Substr("path", len(old_path) + 1), output_field=CharField()),
+                    depth=F("depth") + (depth - old_path.count(self.PATH_SEPARATOR) + 1),
+                )
+            if self.path != path:
+                manager.filter(pk=self.pk).update(path=path, depth=depth)
+            self.path, self.depth = path, depth
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """MaterializedPathHierarchyMixin Meta class"""
+
+        abstract = True
+
+
+class UniquePathCacheMixin(NaiveHierarchyMixin):
+    """
+    Naive hierarchy persisting the unique path of each node (opt-in).
+
+    The path string is computed lazily and stored. Saving a node empties the
+    cache of the node and of its whole subtree, as moving or renaming a node
+    changes the path of all its descendants.
+    """
+
+    UNIQUE_PATH_SEPARATOR = " / "
+
+    unique_path = TextField(
+        verbose_name=_("unique path"),
+        help_text=_("Cached logical path, from the root to this node"),
+        null=True,
+        blank=True,
+        editable=False,
+    )
+
+    @classmethod
+    def get_unique_paths(cls, nodes):
+        """Get unique paths of many nodes, computing the missing ones in bulk"""
+        nodes = list(nodes)
+        missing = [node for node in nodes if node.unique_path is None]
+        if missing:
+            paths = cls.tree.resolve_paths(missing, as_string=True, separator=cls.UNIQUE_PATH_SEPARATOR)
+            for node in missing:
+                node.unique_path = paths[node.pk]
+            # Filling the cache changes no traversal: skip their invalidation
+            cls._base_manager.bulk_update(missing, ["unique_path"])
+        return {node.pk: node.unique_path for node in nodes}
+
+    def get_unique_path(self):
+        """Get the unique path of the node, from the cache when possible"""
+        return self.get_unique_paths([self])[self.pk]
+
+    def save(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Save the node and invalidate the cached paths of its subtree"""
+        adding = self._state.adding
+        self.unique_path = None
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "unique_path" not in update_fields:
+            kwargs["update_fields"] = list(update_fields) + ["unique_path"]
+        super().save(*args, **kwargs)
+        if not adding:
+            type(self).tree.descendants_of(self).update(unique_path=None)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """UniquePathCacheMixin Meta class"""
+
+        abstract = True
+
+
 class StatusMixin(Model):
     """Must be inherited by models using a workflow based on status"""
 
+    # Allowed transitions, as {from label: [to labels]}; None allows any
+    status_transitions = None
+
+    # Opt-in: maintain the number of objects in each status (StatusCounter)
+    count_statuses = False
+
     status = StatusField(
         verbose_name=_("status"),
         related_name="status_%(app_label)s_%(class)s_set",
@@ -203,11 +730,75 @@ class StatusMixin(Model):
     @classmethod
     def get_default_status(cls):
         """Automatically get the default status"""
-        model = ".".join([
-            cls._meta.app_label,
-            cls._meta.model_name,
-        ])
-        return cls.objects.filter(model=model, is_default=True).first()
+        return status_registry.get_default(cls.get_status_model())
+
+    @classmethod
+    def get_status_model(cls):
+        """Label of the model statuses are attached to (the one owning the field)"""
+        return cls._meta.get_field("status").model._meta.label_lower
+
+    @classmethod
+    def get_status(cls, label):
+        """Get one of the statuses of the model from its label"""
+        return status_registry.get_by_label(cls.get_status_model(), label)
+
+    @classmethod
+    def get_status_counts(cls):
+        """Number of objects in each status, as {label: count} (count_statuses)"""
+        model = cls.get_status_model()
+        counts = StatusCounter.objects.counts(model)
+        return {status.label: counts.get(status.pk, 0) for status in status_registry.get_statuses(model)}
+
+    @classmethod
+    def check_transition(cls, from_status, to_status):
+        """Ensure that a status change is declared in status_transitions"""
+        if cls.status_transitions is None:
+            return
+        if to_status.label not in cls.status_transitions.get(from_status.label, ()):
+            raise ValidationError(
+                _("Status can not change from %(from)s to %(to)s."),
+                code="transition",
+                params={"from": from_status.label, "to": to_status.label},
+            )
+
+    @classmethod
+    def transition(cls, queryset, to_status, actor=None):
+        """
+        Change the status of all the objects of a QuerySet.
+
+        Transitions are validated, applied with a single UPDATE and recorded
+        with a single bulk_create of StatusTransition rows. Objects already
+        in the target status are left alone. Neither save() nor model signals
+        are called. Returns the number of changed objects.
+        """
+        model = cls.get_status_model()
+        if not isinstance(to_status, Status):
+            to_status = status_registry.get_by_label(model, to_status)
+        elif to_status.model != model:
+            raise ValidationError(_("This status does not belong to this model."), code="transition")
+        using = queryset.db
+        with transaction.atomic(using=using):
+            queryset = queryset.exclude(status=to_status)
+            rows = list(queryset.select_for_update().values_list("pk", "status"))
+            if not rows:
+                return 0
+            for from_status_id in {status_id for _pk, status_id in rows}:
+                cls.check_transition(status_registry.get_by_pk(model, from_status_id), to_status)
+            # Only change the validated rows: re-running the filter could
+            # match rows committed after the lock
+            cls._base_manager.using(using).filter(pk__in=[pk for pk, _status_id in rows]).update(status=to_status)
+            if cls.count_statuses:
+                counters = StatusCounter.objects.db_manager(using)
+                for from_status_id, count in Counter(status_id for _pk, status_id in rows).items():
+                    counters.add(model, from_status_id, -count)
+                counters.add(model, to_status.pk, len(rows))
+            date = now()
+            StatusTransition.objects.using(using).bulk_create(
+                StatusTransition(model=model, object_id=pk, from_status_id=status_id,
+                                 to_status=to_status, actor=actor, date=date)
+                for pk, status_id in rows
+            )
+        return len(rows)
 
     class Meta:  # pylint: disable=too-few-public-methods
         """StatusMixin Meta class"""
@@ -215,6 +806,89 @@ class StatusMixin(Model):
         abstract = True
 
 
+def _remember_previous_status(sender, instance, raw, using, **kwargs):  # pylint: disable=unused-argument
+    """Read the status stored before the save, to count changes"""
+    if instance._state.adding:
+        instance._previous_status_id = None
+    else:
+        instance._previous_status_id = (sender._base_manager.using(using)
+                                        .filter(pk=instance.pk)
+                                        .values_list("status", flat=True)
+                                        .first())
+
+
+def _count_saved_status(sender, instance, using, **kwargs):  # pylint: disable=unused-argument
+    """Update counters after a creation or a status change"""
+    previous = getattr(instance, "_previous_status_id", None)
+    if previous == instance.status_id:
+        return
+    counters = StatusCounter.objects.db_manager(using)
+    model = sender.get_status_model()
+    if previous is not None:
+        counters.add(model, previous, -1)
+    counters.add(model, instance.status_id, 1)
+
+
+def _count_deleted_status(sender, instance, using, **kwargs):  # pylint: disable=unused-argument
+    """Update counters after a deletion"""
+    # Deleting a child of a multi-table inheritance also deletes, and
+    # signals, the parent row: only count the model owning the field.
+    if sender._meta.get_field("status").model is sender:
+        StatusCounter.objects.db_manager(using).add(sender.get_status_model(), instance.status_id, -1)
+
+
+@receiver(signals.class_prepared)
+def _connect_status_counters(sender, **kwargs):  # pylint: disable=unused-argument
+    """Maintain status counters of the models enabling count_statuses"""
+    if issubclass(sender, StatusMixin) and sender.count_statuses and not sender._meta.abstract:
+        signals.pre_save.connect(_remember_previous_status, sender=sender)
+        signals.post_save.connect(_count_saved_status, sender=sender)
+        signals.post_delete.connect(_count_deleted_status, sender=sender)
+
+
+class LocalisationQuerySet(QuerySet):
+    """QuerySet used by LocalisationMixin models"""
+
+    def with_address(self):
+        """
+        Annotate rendered_address, the address compiled by the database.
+
+        A whole page (or export) gets its addresses from a single query,
+        joining states and countries, with the same layout as the address
+        property. The annotation is not updated when fields change.
+        """
+        return self.annotate(rendered_address=Concat(
+            "address1",
+            Case(
+                When(Q(address2__isnull=True) | Q(address2=""), then=Value("")),
+                default=Concat(Value("\n"), "address2"),
+            ),
+            Value("\n"),
+            "zip",
+            Value(" "),
+            "city",
+            Case(
+                When(state__isnull=True, then=Value("")),
+                default=Concat(Value(" "), "state__label"),
+            ),
+            Value("\n"),
+            "country__label",
+            output_field=TextField(),
+        ))
+
+
+class LocalisationManager(Manager):
+    """Manager for Models using the Localisation Mixin"""
+
+    def get_queryset(self):
+        """Return the query set"""
+        return LocalisationQuerySet(self.model, using=self._db)
+
+    def with_address(self):
+        """Annotate the compiled address of each object"""
+        return self.get_queryset().with_address()
+
+
 class LocalisationMixin(Model):
     """Add localisation information"""
 
@@ -250,7 +924,7 @@ class LocalisationMixin(Model):
         blank=False,
     )
 
-    state = ForeignKey(
+    state = ReferenceForeignKey(
         verbose_name=_("state"),
         related_name="%(app_label)s_%(class)s_set",
         help_text=_("State"),
@@ -260,7 +934,7 @@ class LocalisationMixin(Model):
         on_delete=PROTECT,
     )
 
-    country = ForeignKey(
+    country = ReferenceForeignKey(
         verbose_name=_("country"),
         related_name="%(app_label)s_%(class)s_set",
         help_text=_("Country"),
@@ -270,13 +944,21 @@ class LocalisationMixin(Model):
         on_delete=PROTECT,
     )
 
+    # Declared first, so that objects stays the default manager
+    objects = Manager()
+
+    localised_objects = LocalisationManager()
+
     @property
     def address(self):
-        """Compile address"""
+        """Compile address (from the fields, see with_address for pages)"""
         result = [self.address1]
         if self.address2:
             result.append(self.address2)
-        result.append(" ".join((self.zip, self.city, self.state.label)))
+        city = [self.zip, self.city]
+        if self.state_id is not None:
+            city.append(self.state.label)
+        result.append(" ".join(city))
         result.append(self.country.label)
         return "\n".join(result)
 
@@ -286,10 +968,53 @@ class LocalisationMixin(Model):
         abstract = True
 
 
+class AddressCacheMixin(LocalisationMixin):
+    """
+    Localisation persisting the compiled address (opt-in), for exports.
+
+    The address is compiled on save. As renaming a state or a country does
+    not update the rows using it, refresh_addresses() rebuilds them in bulk.
+    """
+
+    full_address = TextField(
+        verbose_name=_("full address"),
+        help_text=_("Compiled address"),
+        blank=True,
+        editable=False,
+    )
+
+    @classmethod
+    def refresh_addresses(cls, queryset=None, batch_size=1000):
+        """Compile the stored addresses of many objects, batch by batch"""
+        queryset = cls.localised_objects.all() if queryset is None else queryset
+        rows = queryset.with_address().order_by("pk").values_list("pk", "rendered_address")
+        batch = []
+        for pk, address in rows.iterator():
+            batch.append(cls(pk=pk, full_address=address))
+            if len(batch) == batch_size:
+                cls._base_manager.bulk_update(batch, ["full_address"])
+                batch = []
+        if batch:
+            cls._base_manager.bulk_update(batch, ["full_address"])
+
+    def save(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Compile the address, then save the object"""
+        self.full_address = self.address
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "full_address" not in update_fields:
+            kwargs["update_fields"] = list(update_fields) + ["full_address"]
+        super().save(*args, **kwargs)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """AddressCacheMixin Meta class"""
+
+        abstract = True
+
+
 class SettingsMixin(Model):
     """Allow to customize data (Dates and Language)"""
 
-    locale = ForeignKey(
+    locale = ReferenceForeignKey(
         verbose_name=_("locale"),
         related_name="%(app_label)s_%(class)s_set",
         help_text=_("Locale"),
@@ -299,7 +1024,7 @@ class SettingsMixin(Model):
         on_delete=PROTECT,
     )
 
-    timezone = ForeignKey(
+    timezone = ReferenceForeignKey(
         verbose_name=_("timezone"),
         related_name="%(app_label)s_%(class)s_set",
         help_text=_("Timezone"),
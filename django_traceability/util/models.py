@@ -4,18 +4,30 @@
 # TODO: Add a comment model
 
 
+from django.conf import settings
 from django.db.models import (
+    Manager,
     Model,
     BooleanField,
     CharField,
+    DateTimeField,
+    IntegerField,
+    OneToOneField,
+    PositiveIntegerField,
+    F,
     PositiveSmallIntegerField,
     ForeignKey,
     ManyToManyField,
-    FloatField, CASCADE, PROTECT)
+    FloatField,
+    Index,
+    CASCADE, PROTECT, SET_NULL)
 
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from hvad.models import TranslatableModel, TranslatedFields
 
+from .timeframe import TimeFramedMixin
+
 
 #
 # Status
@@ -58,6 +70,115 @@ class Status(Model):
 
         verbose_name = _("status")
         verbose_name_plural = _("statuses")
+        indexes = [
+            Index(fields=["model", "is_default"], name="util_status_model_default_idx"),
+            Index(fields=["model", "label"], name="util_status_model_label_idx"),
+        ]
+
+
+class StatusTransition(Model):
+    """History of the status changes applied by StatusMixin.transition"""
+
+    model = CharField(
+        verbose_name=_("model"),
+        help_text=_("Model of the changed object"),
+        max_length=64,
+    )
+
+    object_id = PositiveIntegerField(
+        verbose_name=_("object id"),
+        help_text=_("Primary key of the changed object"),
+    )
+
+    from_status = ForeignKey(
+        verbose_name=_("from status"),
+        help_text=_("Status before the change"),
+        related_name="transition_from_set",
+        to=Status,
+        on_delete=PROTECT,
+    )
+
+    to_status = ForeignKey(
+        verbose_name=_("to status"),
+        help_text=_("Status after the change"),
+        related_name="transition_to_set",
+        to=Status,
+        on_delete=PROTECT,
+    )
+
+    actor = ForeignKey(
+        verbose_name=_("actor"),
+        help_text=_("Who changed the status"),
+        related_name="status_transition_set",
+        to=settings.AUTH_USER_MODEL,
+        null=True,
+        blank=True,
+        on_delete=SET_NULL,
+    )
+
+    date = DateTimeField(
+        verbose_name=_("date"),
+        help_text=_("When the status changed"),
+        default=now,
+    )
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """StatusTransition Meta class"""
+
+        verbose_name = _("status transition")
+        verbose_name_plural = _("status transitions")
+        indexes = [
+            Index(fields=["model", "object_id"], name="util_transition_object_idx"),
+        ]
+
+
+class StatusCounterManager(Manager):
+    """Manager for StatusCounter"""
+
+    def add(self, model, status_id, delta):
+        """Add delta to the counter of a status, creating it when missing"""
+        if not delta:
+            return
+        if not self.filter(status_id=status_id).update(count=F("count") + delta):
+            self.get_or_create(status_id=status_id, defaults={"model": model, "count": 0})
+            self.filter(status_id=status_id).update(count=F("count") + delta)
+
+    def counts(self, model):
+        """Number of objects in each status of a model, as {status id: count}"""
+        return dict(self.filter(model=model).values_list("status", "count"))
+
+
+class StatusCounter(Model):
+    """Number of objects in each status, for models that enable counting"""
+
+    model = CharField(
+        verbose_name=_("model"),
+        help_text=_("Model related to the status"),
+        max_length=64,
+        db_index=True,
+    )
+
+    status = OneToOneField(
+        verbose_name=_("status"),
+        help_text=_("Counted status"),
+        related_name="counter",
+        to=Status,
+        on_delete=CASCADE,
+    )
+
+    count = IntegerField(
+        verbose_name=_("count"),
+        help_text=_("Number of objects in this status"),
+        default=0,
+    )
+
+    objects = StatusCounterManager()
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """StatusCounter Meta class"""
+
+        verbose_name = _("status counter")
+        verbose_name_plural = _("status counters")
 
 
 #
@@ -154,6 +275,14 @@ class StateCategory(Model):
         verbose_name_plural = _("state categories")
 
 
+class StateManager(Manager):
+    """Manager for State"""
+
+    def with_unique_path(self):
+        """Fetch countries along with states, so unique paths need no query"""
+        return self.get_queryset().select_related("country")
+
+
 class State(Model):
     """State"""
 
@@ -191,6 +320,8 @@ class State(Model):
         on_delete=PROTECT,
     )
 
+    objects = StateManager()
+
     def _name_unique_model_path(self):
         """The logical model path to get the current object in a unique way"""
         return self.country, self
@@ -275,6 +406,14 @@ class UnitCategory(Model):
         verbose_name_plural = _("unit categories")
 
 
+class UnitManager(Manager):
+    """Manager for Unit"""
+
+    def with_unique_path(self):
+        """Fetch categories along with units, so unique paths need no query"""
+        return self.get_queryset().select_related("category")
+
+
 class Unit(Model):
     """Configuration parameter"""
 
@@ -314,6 +453,8 @@ class Unit(Model):
         blank=False,
     )
 
+    objects = UnitManager()
+
     def _name_unique_model_path(self):
         return self.category, self
 
@@ -368,3 +509,34 @@ class Currency(Model):
 
         verbose_name = _("currency")
         verbose_name_plural = _("currencies")
+
+
+class CurrencyRate(TimeFramedMixin):
+    """Rate of a currency during a period of time"""
+
+    period_key = ("currency",)
+
+    # Default manager: declared by the model, it comes before the one of the mixin
+    objects = Manager()
+
+    currency = ForeignKey(
+        verbose_name=_("currency"),
+        help_text=_("Currency this rate applies to"),
+        related_name="%(app_label)s_%(class)s_set",
+        to=Currency,
+        on_delete=CASCADE,
+    )
+
+    value = FloatField(
+        verbose_name=_("value"),
+        help_text=_("amount to 1 euros"),
+    )
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """CurrencyRate Meta class"""
+
+        verbose_name = _("currency rate")
+        verbose_name_plural = _("currency rates")
+        indexes = [
+            Index(fields=["currency", "start"], name="util_rate_currency_start_idx"),
+        ]
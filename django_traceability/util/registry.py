@@ -0,0 +1,247 @@
+"""
+Process wide registries of rarely modified data.
+
+Registries are filled lazily and invalidated through model signals. When the
+UTIL_STATUS_REGISTRY_CACHE (or UTIL_REFERENCE_REGISTRY_CACHE) setting names a
+cache alias, invalidations are also shared between workers through a version
+counter stored in that cache.
+"""
+
+from copy import copy
+from types import MappingProxyType
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Status, Country, State, Locale, TimeZone, Unit, Currency
+
+
+class VersionedRegistry:
+    """Registry of lazily loaded entries, optionally shared between workers"""
+
+    setting = None
+    version_key = None
+
+    def __init__(self):
+        self._entries = {}
+        self._version = None
+
+    @property
+    def shared_cache(self):
+        """Cache shared between workers, if any"""
+        alias = getattr(settings, self.setting, None)
+        return caches[alias] if alias else None
+
+    def _sync(self, cache):
+        """Forget local entries when another worker invalidated the registry"""
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, 1, timeout=None)
+            version = cache.get(self.version_key, 1)
+        if version != self._version:
+            self._entries = {}
+            self._version = version
+        return version
+
+    def load(self, key, cache, version):
+        """Build the entry of a key"""
+        raise NotImplementedError
+
+    def get_entry(self, key):
+        """Get the entry of a key, loading it when needed"""
+        cache = self.shared_cache
+        version = self._sync(cache) if cache is not None else None
+        result = self._entries.get(key)
+        if result is None:
+            result = self._entries[key] = self.load(key, cache, version)
+        return result
+
+    def invalidate(self, key=None):
+        """Forget an entry (or everything), in this process and in the shared cache"""
+        if key is None:
+            self._entries = {}
+        else:
+            self._entries.pop(key, None)
+        cache = self.shared_cache
+        if cache is not None:
+            try:
+                cache.incr(self.version_key)
+            except ValueError:
+                cache.add(self.version_key, 1, timeout=None)
+
+
+#
+# Status
+#
+
+
+class StatusSet:
+    """Immutable statuses of one model, indexed by primary key and label"""
+
+    def __init__(self, statuses):
+        self.statuses = tuple(statuses)
+        self.by_pk = MappingProxyType({status.pk: status for status in self.statuses})
+        self.by_label = MappingProxyType({status.label: status for status in self.statuses})
+        self.default = next((status for status in self.statuses if status.is_default), None)
+
+    def __iter__(self):
+        return iter(self.statuses)
+
+    def __len__(self):
+        return len(self.statuses)
+
+    @property
+    def choices(self):
+        """(primary key, label) pairs, for dropdowns"""
+        return [(status.pk, status.label) for status in self.statuses]
+
+
+class StatusRegistry(VersionedRegistry):
+    """Statuses of each model ("app_label.model_name"), kept in memory"""
+
+    setting = "UTIL_STATUS_REGISTRY_CACHE"
+    version_key = "util.status.version"
+
+    def load(self, key, cache, version):
+        """Load all the statuses of a model with a single query"""
+        cache_key = "util.status.{}.{}".format(version, key)
+        statuses = cache.get(cache_key) if cache is not None else None
+        if statuses is None:
+            statuses = list(Status.objects.filter(model=key).order_by("label"))
+            if cache is not None:
+                cache.set(cache_key, statuses, timeout=None)
+        return StatusSet(statuses)
+
+    def get_statuses(self, model):
+        """All the statuses of a model, loaded with a single query"""
+        return self.get_entry(model)
+
+    def get_default(self, model):
+        """Default status of a model, or None"""
+        return self.get_statuses(model).default
+
+    def get_default_id(self, model):
+        """Primary key of the default status of a model, or None"""
+        default = self.get_default(model)
+        return default.pk if default is not None else None
+
+    def get_by_label(self, model, label):
+        """Status of a model having this label"""
+        try:
+            return self.get_statuses(model).by_label[label]
+        except KeyError:
+            raise Status.DoesNotExist("No status {!r} for {}".format(label, model))
+
+    def get_by_pk(self, model, pk):
+        """Status of a model having this primary key"""
+        try:
+            return self.get_statuses(model).by_pk[pk]
+        except KeyError:
+            raise Status.DoesNotExist("No status #{} for {}".format(pk, model))
+
+
+status_registry = StatusRegistry()  # pylint: disable=invalid-name
+
+
+@receiver([post_save, post_delete], sender=Status)
+def invalidate_status_registry(sender, using, **kwargs):  # pylint: disable=unused-argument
+    """Statuses changed: forget them now, and again once committed"""
+    status_registry.invalidate()
+    transaction.on_commit(status_registry.invalidate, using=using)
+
+
+#
+# Reference data
+#
+
+
+def copy_row(row):
+    """Copy of a reference row (and of the related rows loaded with it)"""
+    result = copy(row)
+    result._state = copy(row._state)  # pylint: disable=protected-access
+    result._state.fields_cache = {  # pylint: disable=protected-access
+        name: copy_row(value) if value is not None else None
+        for name, value in row._state.fields_cache.items()  # pylint: disable=protected-access
+    }
+    return result
+
+
+class ReferenceTable:
+    """
+    Rows of a reference model, indexed by primary key and codes.
+
+    Rows are shared by the whole process and must not be modified: get() and
+    get_by() return copies.
+    """
+
+    def __init__(self, rows, keys):
+        self.rows = tuple(rows)
+        self.by_pk = MappingProxyType({row.pk: row for row in self.rows})
+        self.by_key = MappingProxyType({
+            key: MappingProxyType({getattr(row, key): row for row in self.rows})
+            for key in keys
+        })
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class ReferenceRegistry(VersionedRegistry):
+    """Reference tables (countries, states, currencies...), kept in memory"""
+
+    setting = "UTIL_REFERENCE_REGISTRY_CACHE"
+    version_key = "util.reference.version"
+
+    # Registered models, with their codes and the relations to load with them
+    models = {
+        Country: {"keys": ("alpha2", "alpha3", "number")},
+        State: {"keys": ("code",), "related": ("country", "category")},
+        Locale: {"keys": ()},
+        TimeZone: {"keys": ()},
+        Unit: {"keys": (), "related": ("category",)},
+        Currency: {"keys": ("iso_code",)},
+    }
+
+    def load(self, key, cache, version):
+        """Load a whole reference table with a single query"""
+        options = self.models[key]
+        rows = key._base_manager.select_related(*options.get("related", ()))
+        return ReferenceTable(rows, options["keys"])
+
+    def get_table(self, model):
+        """All the rows of a reference model (shared: read only)"""
+        return self.get_entry(model)
+
+    def get(self, model, pk):
+        """Row of a reference model having this primary key (a copy)"""
+        try:
+            return copy_row(self.get_table(model).by_pk[pk])
+        except KeyError:
+            raise model.DoesNotExist("No {} #{}".format(model._meta.verbose_name, pk))
+
+    def get_by(self, model, key, value):
+        """Row of a reference model from one of its codes (alpha2, iso_code...), a copy"""
+        try:
+            return copy_row(self.get_table(model).by_key[key][value])
+        except KeyError:
+            raise model.DoesNotExist("No {} with {} {!r}".format(model._meta.verbose_name, key, value))
+
+
+reference_registry = ReferenceRegistry()  # pylint: disable=invalid-name
+
+
+def invalidate_reference_registry(sender, using, **kwargs):  # pylint: disable=unused-argument
+    """A reference row changed: reload its table on next use"""
+    reference_registry.invalidate(sender)
+    transaction.on_commit(lambda: reference_registry.invalidate(sender), using=using)
+
+
+for _model in ReferenceRegistry.models:
+    post_save.connect(invalidate_reference_registry, sender=_model)
+    post_delete.connect(invalidate_reference_registry, sender=_model)
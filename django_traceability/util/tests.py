@@ -3,3 +3,1301 @@ Test cases
 
 TODO.
 """
+
+from datetime import date, datetime, timedelta
+import json
+from io import StringIO
+from itertools import groupby
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from threading import Barrier, Thread
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.core.exceptions import ValidationError
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.models import CharField
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import make_aware, now
+
+from util import conversion, timeframe
+from util.mixins import (
+    AddressCacheMixin,
+    LocalisationMixin,
+    MaterializedPathHierarchyMixin,
+    NaiveHierarchyMixin,
+    StatusMixin,
+    TimeFramedMixin,
+    UniquePathCacheMixin,
+)
+from util.models import (
+    Country,
+    Currency,
+    CurrencyRate,
+    State,
+    StateCategory,
+    Status,
+    StatusCounter,
+    StatusTransition,
+    Unit,
+    UnitCategory,
+)
+from util.registry import reference_registry, status_registry
+from util.timeframe import PeriodTree, find_overlapping_periods
+from util.tree import Tree
+
+
+class Directory(NaiveHierarchyMixin):
+    """Concrete hierarchy used to test NaiveHierarchyMixin"""
+
+    label = CharField(max_length=32)
+
+    group = CharField(max_length=32)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Directory Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class Folder(MaterializedPathHierarchyMixin):
+    """Concrete hierarchy used to test MaterializedPathHierarchyMixin"""
+
+    label = CharField(max_length=32)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Folder Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class CachedDirectory(NaiveHierarchyMixin):
+    """Naive hierarchy caching its traversals"""
+
+    cache_hierarchy = True
+
+    label = CharField(max_length=32)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """CachedDirectory Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class CachedFolder(MaterializedPathHierarchyMixin):
+    """Materialized path hierarchy caching its traversals"""
+
+    cache_hierarchy = True
+
+    label = CharField(max_length=32)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """CachedFolder Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class Category(UniquePathCacheMixin):
+    """Concrete hierarchy used to test UniquePathCacheMixin"""
+
+    label = CharField(max_length=32)
+
+    def __str__(self):
+        return self.label
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Category Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class Period(TimeFramedMixin):
+    """Concrete time framed model used to test TimeFramedMixin"""
+
+    label = CharField(max_length=32)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Period Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class Shift(TimeFramedMixin):
+    """Time framed model whose periods must not overlap within a team"""
+
+    period_key = ("team",)
+
+    team = CharField(max_length=32)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Shift Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class CachedPeriod(TimeFramedMixin):
+    """Time framed model keeping its periods in memory"""
+
+    cache_periods = True
+
+    track_current_periods = True
+
+    label = CharField(max_length=32)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """CachedPeriod Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class Ticket(StatusMixin):
+    """Concrete model used to test StatusMixin"""
+
+    status_transitions = {"open": ["closed"], "closed": []}
+
+    count_statuses = True
+
+    label = CharField(max_length=32)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Ticket Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class UrgentTicket(Ticket):
+    """Multi-table child of Ticket, sharing its statuses"""
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """UrgentTicket Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class Site(LocalisationMixin):
+    """Concrete model used to test LocalisationMixin"""
+
+    label = CharField(max_length=32)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Site Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class Office(AddressCacheMixin):
+    """Concrete model used to test AddressCacheMixin"""
+
+    label = CharField(max_length=32)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Office Meta class"""
+
+        app_label = "util"
+        managed = False  # Table created by the test case, not by migrations
+
+
+class TestModelsMixin:
+    """Create the tables of the (unmanaged) models defined for tests"""
+
+    models = ()
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with connection.schema_editor() as editor:
+            for model in cls.models:
+                editor.create_model(model)
+                # Indexes of unmanaged models are not created with them
+                for index in model._meta.indexes:  # pylint: disable=protected-access
+                    editor.add_index(model, index)
+
+    @classmethod
+    def tearDownClass(cls):
+        with connection.schema_editor() as editor:
+            for model in cls.models:
+                editor.delete_model(model)
+        super().tearDownClass()
+
+    def tearDown(self):
+        for model in reversed(self.models):
+            model._base_manager.all().delete()  # pylint: disable=protected-access
+        super().tearDown()
+
+
+class RootFiltersConcurrencyTestCase(TestModelsMixin, TransactionTestCase):
+    """Root filters must not leak between threads sharing the manager"""
+
+    models = (Directory,)
+
+    groups = ["group-{}".format(index) for index in range(8)]
+
+    def setUp(self):
+        for group in self.groups:
+            root = Directory.tree.create(label=group, group=group)
+            for other in self.groups:
+                Directory.tree.create(label="{} in {}".format(other, group), group=other, parent=root)
+
+    def test_filtered_children_under_concurrency(self):
+        """Each thread only sees children matching its own root filters"""
+        barrier = Barrier(len(self.groups))
+        errors = []
+
+        def browse(group):
+            try:
+                barrier.wait()
+                for _ in range(25):
+                    for root in Directory.get_roots(group=group):
+                        groups = {child.group for child in root.get_filtered_children()}
+                        if groups != {group}:
+                            errors.append((group, groups))
+            finally:
+                connection.close()
+
+        threads = [Thread(target=browse, args=(group,)) for group in self.groups]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_root_filters_propagate_to_descendants(self):
+        """Objects found from filtered roots keep the filters"""
+        root = Directory.get_roots(group="group-0").get()
+        child = root.get_filtered_children().get()
+        self.assertEqual(child.root_filters, {"group": "group-0"})
+        self.assertEqual(Directory.get_roots().get(label="group-1").root_filters, {})
+
+
+@skipUnless(connection.vendor == "sqlite", "Cost measured in SQLite virtual machine steps")
+class InEffectBenchmarkTestCase(TestModelsMixin, TransactionTestCase):
+    """Finding objects in effect must not slow down as history grows"""
+
+    models = (Period,)
+
+    def setUp(self):
+        self.date = now()
+        Period.time_framed_objects.create(label="current", start=self.date - timedelta(hours=1))
+        self.history = 0
+
+    def add_history(self, count):
+        """Add closed periods, ended before the current one started"""
+        Period.time_framed_objects.bulk_create(
+            Period(
+                label="past",
+                start=self.date - timedelta(hours=self.history + index + 3),
+                end=self.date - timedelta(hours=self.history + index + 2),
+            )
+            for index in range(count)
+        )
+        self.history += count
+
+    def measure(self, queryset):
+        """Number of virtual machine steps (by 10 instructions) to run a query"""
+        steps = [0]
+
+        def progress():
+            steps[0] += 1
+            return 0
+
+        connection.ensure_connection()
+        connection.connection.set_progress_handler(progress, 10)
+        try:
+            self.assertEqual([period.label for period in queryset], ["current"])
+        finally:
+            connection.connection.set_progress_handler(None, 10)
+        return steps[0]
+
+    def test_cost_stays_flat(self):
+        """in_effect and in_effect_at cost the same with 1k or 50k past periods"""
+        costs = {}
+        for count in (1000, 49000):
+            self.add_history(count)
+            costs[self.history] = (
+                self.measure(Period.time_framed_objects.in_effect),
+                self.measure(Period.time_framed_objects.in_effect_at(self.date)),
+            )
+        self.assertEqual(costs[1000], costs[50000], costs)
+
+    def test_boundaries(self):
+        """Periods are half-open: in effect from their start, not at their end"""
+        current = Period.time_framed_objects.get()
+        current.end = self.date
+        current.save()
+        self.assertTrue(Period.time_framed_objects.in_effect_at(current.start).exists())
+        self.assertFalse(Period.time_framed_objects.in_effect_at(current.end).exists())
+
+
+class TimeFramedTestCase(TestModelsMixin, TransactionTestCase):
+    """Lookups of TimeFramedMixin models on random periods"""
+
+    models = (Period,)
+
+    def setUp(self):
+        super().setUp()
+        self.random = Random(42)
+        self.origin = now().replace(microsecond=0)
+
+    def hours(self, count):
+        """Date count hours after the origin"""
+        return self.origin + timedelta(hours=count)
+
+    def random_periods(self, count, span=100):
+        """Random periods starting in the span (hours), some of them open or sharing their bounds"""
+        periods = []
+        for index in range(count):
+            start = self.random.randrange(span)
+            end = None if self.random.random() < 0.2 else start + self.random.randrange(1, span * 3 // 10)
+            periods.append(Period(label=str(index), start=self.hours(start), end=end and self.hours(end)))
+        return periods
+
+    def create_periods(self, count, span=100):
+        """Store random periods"""
+        return Period.time_framed_objects.bulk_create(self.random_periods(count, span))
+
+    def test_in_effect_at_many(self):
+        """in_effect_at_many finds what in_effect_at finds, with one query"""
+        self.create_periods(500, span=366 * 24)
+        dates = [self.hours(day * 24) for day in range(366)]
+        with self.assertNumQueries(1):
+            pairs = list(Period.time_framed_objects.in_effect_at_many(dates + dates[:10]))
+        self.assertEqual([date for date, _period in pairs], sorted(date for date, _period in pairs))
+        found = {date: sorted(period.pk for _date, period in group)
+                 for date, group in groupby(pairs, key=lambda pair: pair[0])}
+        for date in set(dates):
+            expected = sorted(Period.time_framed_objects.in_effect_at(date).values_list("pk", flat=True))
+            self.assertEqual(found.get(date, []), expected, date)
+
+    def test_period_tree(self):
+        """PeriodTree finds what a scan of all the periods finds, without query"""
+        periods = self.random_periods(2000, span=1000)
+        for index, period in enumerate(periods):
+            period.pk = index
+        tree = PeriodTree(periods)
+
+        def check(found, expected):
+            self.assertEqual(sorted(period.pk for period in found), sorted(period.pk for period in expected))
+            self.assertEqual([period.start for period in found], sorted(period.start for period in found))
+
+        with self.assertNumQueries(0):
+            for _index in range(100):  # 300 point and range queries
+                date = self.hours(self.random.randrange(-10, 1400))
+                check(tree.at(date), [period for period in periods
+                                      if period.start <= date and (period.end is None or period.end > date)])
+                start = self.hours(self.random.randrange(-10, 1400))
+                end = start + timedelta(hours=self.random.randrange(1, 200))
+                check(tree.overlapping(start, end), [period for period in periods if period.start < end
+                                                     and (period.end is None or period.end > start)])
+                check(tree.overlapping(start), [period for period in periods
+                                                if period.end is None or period.end > start])
+
+    def test_find_overlapping_periods(self):
+        """Every period overlapping another one is reported, in actual overlaps"""
+        def overlap(first, second):
+            return ((first.end is None or second.start < first.end)
+                    and (second.end is None or first.start < second.end))
+
+        for count in (0, 1, 5, 20, 100):
+            periods = self.random_periods(count)
+            pairs = find_overlapping_periods(periods)
+            for first, second in pairs:
+                self.assertTrue(overlap(first, second))
+            self.assertEqual(
+                {period.label for pair in pairs for period in pair},
+                {period.label for period in periods
+                 if any(other is not period and overlap(period, other) for other in periods)},
+            )
+        contiguous = [Period(start=self.hours(index), end=self.hours(index + 1)) for index in range(5)]
+        self.assertEqual(find_overlapping_periods(contiguous), [])
+
+
+class PeriodOverlapTestCase(TestModelsMixin, TransactionTestCase):
+    """Periods sharing a period_key must not overlap"""
+
+    models = (Shift,)
+
+    def setUp(self):
+        super().setUp()
+        self.origin = now().replace(microsecond=0)
+        self.morning = Shift.time_framed_objects.create(team="a", start=self.hours(8), end=self.hours(12))
+        Shift.time_framed_objects.create(team="a", start=self.hours(12))
+        Shift.time_framed_objects.create(team="b", start=self.hours(8), end=self.hours(18))
+
+    def hours(self, count):
+        """Date count hours after the origin"""
+        return self.origin + timedelta(hours=count)
+
+    def test_find_overlaps(self):
+        """Candidates are checked against stored rows with one query per key"""
+        overlapping = Shift(team="a", start=self.hours(10), end=self.hours(11))
+        separate = Shift(team="b", start=self.hours(18), end=self.hours(20))
+        with self.assertNumQueries(2):
+            overlaps = Shift.find_overlaps([overlapping, separate])
+        self.assertEqual([(first.pk, second) for first, second in overlaps], [(self.morning.pk, overlapping)])
+
+    def test_find_overlaps_ignores_replaced_rows(self):
+        """A candidate replaces the stored row having its primary key"""
+        self.morning.start, self.morning.end = self.hours(6), self.hours(10)
+        self.assertEqual(Shift.find_overlaps([self.morning]), [])
+        self.morning.end = self.hours(13)
+        self.assertEqual(len(Shift.find_overlaps([self.morning])), 1)
+
+    def test_clean(self):
+        """Empty periods and overlaps are refused"""
+        for end in (self.hours(20), self.hours(19)):
+            with self.assertRaises(ValidationError) as context:
+                Shift(team="c", start=self.hours(20), end=end).clean()
+            self.assertIn("end", context.exception.message_dict)
+        with self.assertRaises(ValidationError) as context:
+            Shift(team="b", start=self.hours(17)).clean()
+        self.assertEqual(context.exception.error_list[0].code, "overlap")
+        Shift(team="b", start=self.hours(18)).clean()
+
+
+class PeriodCacheTestCase(TestModelsMixin, TransactionTestCase):
+    """Cached periods are forgotten when an object is saved or deleted"""
+
+    models = (CachedPeriod,)
+
+    def setUp(self):
+        super().setUp()
+        CachedPeriod.time_framed_objects.invalidate_periods()
+        self.date = now()
+        self.period = CachedPeriod.time_framed_objects.create(label="a", start=self.date - timedelta(hours=1))
+
+    def cached_labels(self):
+        """Labels of the objects in effect, from both caches"""
+        manager = CachedPeriod.time_framed_objects
+        return (
+            [period.label for period in manager.cached_in_effect_at(self.date)],
+            sorted(manager.cached_in_effect.values_list("label", flat=True)),
+        )
+
+    def test_cached(self):
+        """Periods are loaded once"""
+        self.cached_labels()
+        with self.assertNumQueries(1):  # cached_in_effect itself
+            self.assertEqual(self.cached_labels(), (["a"], ["a"]))
+
+    def test_invalidated_on_save(self):
+        """Created and changed objects are seen at once"""
+        self.assertEqual(self.cached_labels(), (["a"], ["a"]))
+        CachedPeriod.time_framed_objects.create(label="b", start=self.date - timedelta(minutes=1))
+        self.assertEqual(self.cached_labels(), (["a", "b"], ["a", "b"]))
+        self.period.end = self.date - timedelta(minutes=30)
+        self.period.save()
+        self.assertEqual(self.cached_labels(), (["b"], ["b"]))
+
+    def test_recomputed_at_boundary(self):
+        """Current ids are kept until the clock reaches the next start or end"""
+        CachedPeriod.time_framed_objects.create(label="b", start=self.date + timedelta(hours=1))
+        manager = CachedPeriod.time_framed_objects
+        self.assertEqual(manager.get_current_periods().until, self.date + timedelta(hours=1))
+        with self.assertNumQueries(0):
+            self.assertEqual(len(manager.current_ids()), 1)
+        with patch.object(timeframe, "now", return_value=self.date + timedelta(hours=1)):
+            self.assertEqual(len(manager.current_ids()), 2)
+            self.assertIsNone(manager.get_current_periods().until)
+
+    @override_settings(UTIL_PERIOD_CACHE="default")
+    def test_invalidated_by_other_workers(self):
+        """Invalidations of other workers are read from the shared cache"""
+        self.assertEqual(self.cached_labels(), (["a"], ["a"]))
+        # Another worker adds a period: only the shared version changes here
+        CachedPeriod.time_framed_objects.bulk_create([
+            CachedPeriod(label="b", start=self.date - timedelta(minutes=1)),
+        ])
+        self.assertEqual(self.cached_labels(), (["a"], ["a"]))
+        caches["default"].incr(timeframe._version_key(CachedPeriod))  # pylint: disable=protected-access
+        self.assertEqual(self.cached_labels(), (["a", "b"], ["a", "b"]))
+
+    def test_invalidated_on_delete(self):
+        """Deleted objects are forgotten at once"""
+        self.assertEqual(self.cached_labels(), (["a"], ["a"]))
+        self.period.delete()
+        self.assertEqual(self.cached_labels(), ([], []))
+
+
+class ChildrenAnnotationsTestCase(TestModelsMixin, TransactionTestCase):
+    """Whether nodes have children, for a whole page in one statement"""
+
+    models = (Directory,)
+
+    def setUp(self):
+        self.root = Directory.tree.create(label="root", group="a")
+        Directory.tree.create(label="a", group="a", parent=self.root)
+        Directory.tree.create(label="b", group="b", parent=self.root)
+        self.mixed = Directory.tree.create(label="mixed", group="a")
+        Directory.tree.create(label="b", group="b", parent=self.mixed)
+        Directory.tree.create(label="leaf", group="a")
+
+    def test_with_has_children(self):
+        """Children are checked with the root filters, or without them"""
+        with self.assertNumQueries(1):
+            roots = list(Directory.tree.get_roots(group="a").with_has_children().order_by("pk"))
+            self.assertEqual([node.has_filtered_children() for node in roots], [True, False, False])
+        with self.assertNumQueries(1):
+            roots = list(Directory.tree.get_roots(group="a").with_has_children(use_root_filters=False).order_by("pk"))
+            self.assertEqual([node.has_children() for node in roots], [True, True, False])
+
+    def test_with_child_count(self):
+        """Children are counted with the root filters, or without them"""
+        with self.assertNumQueries(1):
+            roots = list(Directory.tree.get_roots(group="a").with_child_count().order_by("pk"))
+            self.assertEqual([node.filtered_child_count for node in roots], [1, 0, 0])
+            self.assertEqual([node.has_filtered_children() for node in roots], [True, False, False])
+        with self.assertNumQueries(1):
+            roots = list(Directory.tree.get_roots(group="a").with_child_count(use_root_filters=False).order_by("pk"))
+            self.assertEqual([node.child_count for node in roots], [2, 1, 0])
+            self.assertEqual([node.has_children() for node in roots], [True, True, False])
+
+    def test_without_annotations(self):
+        """Without annotations, each node runs its own query"""
+        roots = list(Directory.tree.get_roots(group="a").order_by("pk"))
+        with self.assertNumQueries(3):
+            self.assertEqual([node.has_filtered_children() for node in roots], [True, False, False])
+
+
+class LoadTreeTestCase(TestModelsMixin, TransactionTestCase):
+    """Whole hierarchies loaded in memory"""
+
+    models = (Directory, CachedDirectory)
+
+    def setUp(self):
+        root = Directory.tree.create(label="root", group="a")
+        first = Directory.tree.create(label="first", group="a", parent=root)
+        Directory.tree.create(label="first.1", group="a", parent=first)
+        Directory.tree.create(label="first.2", group="b", parent=first)
+        Directory.tree.create(label="second", group="a", parent=root)
+        Directory.tree.create(label="other", group="b")
+
+    def test_load_tree(self):
+        """One query loads the requested fields of all the nodes"""
+        with self.assertNumQueries(1):
+            tree = Directory.tree.load_tree("label")
+        self.assertEqual(len(tree), 6)
+        self.assertEqual([node["label"] for node in tree.roots], ["root", "other"])
+        node = tree[Directory.tree.get(label="first").pk]
+        self.assertEqual((node.data, node.depth, node.parent["label"]), ({"label": "first"}, 1, "root"))
+        self.assertIn(node.pk, tree)
+        self.assertIsNone(tree.get(0))
+
+    def test_root_filters(self):
+        """Root filters apply to every node"""
+        tree = Directory.tree.load_tree("label", group="a")
+        self.assertEqual([node["label"] for node in tree.iter_depth_first()], ["root", "first", "first.1", "second"])
+
+    def test_iterators(self):
+        """Depth first and breadth first traversals of the tree and of subtrees"""
+        tree = Directory.tree.load_tree("label")
+        self.assertEqual([node["label"] for node in tree.iter_depth_first()],
+                         ["root", "first", "first.1", "first.2", "second", "other"])
+        self.assertEqual([node["label"] for node in tree.iter_breadth_first()],
+                         ["root", "other", "first", "second", "first.1", "first.2"])
+        root = tree.roots[0]
+        self.assertEqual([node["label"] for node in root.iter_breadth_first()],
+                         ["root", "first", "second", "first.1", "first.2"])
+
+    def test_unreachable_rows(self):
+        """Orphans and cycles are left out"""
+        rows = [(1, None, "root"), (2, 1, "child"), (3, 4, "cycle"), (4, 3, "cycle"), (5, 9, "orphan")]
+        tree = Tree(("label",), rows)
+        self.assertEqual(sorted(node.pk for node in tree.iter_depth_first()), [1, 2])
+        self.assertNotIn(3, tree)
+
+    def test_to_json(self):
+        """Nested dicts, in JSON"""
+        tree = Directory.tree.load_tree("label", group="a")
+        first, leaf = Directory.tree.get(label="first"), Directory.tree.get(label="first.1")
+        self.assertEqual(json.loads(tree.to_json())[0]["children"][0], {
+            "pk": first.pk, "label": "first",
+            "children": [{"pk": leaf.pk, "label": "first.1", "children": []}],
+        })
+
+    def test_cached_deep_tree(self):
+        """Deep trees are cached (pickled) without recursion"""
+        CachedDirectory.tree.bulk_create(
+            CachedDirectory(pk=pk, parent_id=pk - 1 if pk > 1 else None, label=str(pk)) for pk in range(1, 2001)
+        )
+        CachedDirectory.invalidate_hierarchy_cache()
+        CachedDirectory.tree.load_tree("label")
+        with self.assertNumQueries(0):
+            tree = CachedDirectory.tree.load_tree("label")
+        self.assertEqual(len(tree), 2000)
+        self.assertEqual((tree[2000].depth, tree[2000].parent.pk, tree[1].children[0]["label"]), (1999, 1999, "2"))
+
+
+class RecursiveQueriesTestCase(TestModelsMixin, TransactionTestCase):
+    """descendants_of and ancestors_of are lazy QuerySets, safe on cycles"""
+
+    models = (Directory,)
+
+    def setUp(self):
+        # Created leaf first, so that primary keys do not follow the hierarchy
+        self.chain = [Directory.tree.create(label=label, group="chain") for label in "dcba"][::-1]
+        for parent, node in zip(self.chain, self.chain[1:]):
+            node.parent = parent
+            node.save()
+        Directory.tree.create(label="x", group="other")
+
+    def test_descendants(self):
+        """Descendants can be chained and read as values"""
+        root, second, third, fourth = self.chain
+        self.assertEqual(set(Directory.tree.descendants_of(root)), {second, third, fourth})
+        self.assertEqual(
+            sorted(Directory.tree.descendants_of(root).exclude(label="c").values_list("label", flat=True)),
+            ["b", "d"],
+        )
+        self.assertEqual(Directory.tree.descendants_of(fourth).count(), 0)
+        self.assertEqual(set(Directory.tree.subtree_of(third)), {third, fourth})
+
+    def test_ancestors_from_the_root(self):
+        """Ancestors are sorted from the root to the parent"""
+        root, second, third, fourth = self.chain
+        self.assertEqual(list(Directory.tree.ancestors_of(fourth)), [root, second, third])
+        self.assertEqual(
+            list(Directory.tree.ancestors_of(fourth).exclude(label="b").values_list("label", flat=True)),
+            ["a", "c"],
+        )
+        self.assertEqual(list(Directory.tree.ancestors_of(fourth).values("label")[:1]), [{"label": "a"}])
+        self.assertEqual(list(Directory.tree.ancestors_of(root)), [])
+
+    def test_cycle(self):
+        """Queries stop on a cycle stored in the table"""
+        root, second, third, fourth = self.chain
+        Directory.tree.filter(pk=root.pk).update(parent=fourth)
+        root.refresh_from_db()
+        self.assertEqual(set(Directory.tree.descendants_of(root)), {root, second, third, fourth})
+        self.assertEqual(set(Directory.tree.ancestors_of(second)), {root, second, third, fourth})
+        self.assertEqual(len(Directory.tree.resolve_paths([third])[third.pk]), 4)
+
+
+class CycleTestCase(TestModelsMixin, TransactionTestCase):
+    """Cycles are refused on save, and reported by check_hierarchies"""
+
+    models = (Directory,)
+
+    def setUp(self):
+        self.root = Directory.tree.create(label="a", group="g")
+        self.child = Directory.tree.create(label="b", group="g", parent=self.root)
+        self.leaf = Directory.tree.create(label="c", group="g", parent=self.child)
+
+    def test_cycle_refused(self):
+        """A node can not be moved under itself or one of its descendants"""
+        for parent in (self.root, self.leaf):
+            root = Directory.tree.get(pk=self.root.pk)
+            root.parent = parent
+            with self.assertRaises(ValidationError):
+                root.full_clean()
+            with self.assertRaises(ValidationError):
+                root.save()
+        with self.assertRaises(ValidationError):
+            Directory.tree.get(pk=self.child.pk).move_subtree(self.leaf)
+        self.assertIsNone(Directory.tree.get(pk=self.root.pk).parent_id)
+
+    def test_unchanged_parent_not_checked(self):
+        """Saving a node without changing its parent runs no recursive query"""
+        leaf = Directory.tree.get(pk=self.leaf.pk)
+        leaf.label = "renamed"
+        with CaptureQueriesContext(connection) as context:
+            leaf.save()
+        self.assertEqual(len(context), 1)
+        leaf.parent = Directory.tree.create(label="d", group="g", parent=self.root)
+        with CaptureQueriesContext(connection) as context:
+            leaf.save()
+        self.assertIn("RECURSIVE", context[0]["sql"])
+
+    def check_hierarchies(self):
+        """Output of check_hierarchies on the Directory table"""
+        output = StringIO()
+        try:
+            call_command("check_hierarchies", "util.Directory", stdout=output)
+        except CommandError as error:
+            return output.getvalue() + str(error)
+        return output.getvalue()
+
+    def test_check_hierarchies(self):
+        """Cycles and orphans are reported"""
+        self.assertEqual(self.check_hierarchies(), "util.Directory: 3 nodes, OK\n")
+        Directory.tree.filter(pk=self.root.pk).update(parent=self.leaf)
+        self.assertIn(
+            "cycle {} -> {} -> {}".format(self.root.pk, self.leaf.pk, self.child.pk),
+            self.check_hierarchies(),
+        )
+        Directory.tree.filter(pk=self.root.pk).update(parent=None)
+        with connection.constraint_checks_disabled():
+            Directory.tree.filter(pk=self.leaf.pk).update(parent_id=999)
+        output = self.check_hierarchies()
+        self.assertIn("orphans [{}]".format(self.leaf.pk), output)
+        self.assertIn("1 problem(s) found.", output)
+
+
+class HierarchyCacheTestCase(TestModelsMixin, TransactionTestCase):
+    """Cached traversals are invalidated by any write, even before the commit"""
+
+    models = (CachedDirectory, CachedFolder)
+
+    def create_chain(self, model):
+        """Nodes r > c > d, and an other root o"""
+        root = model.tree.create(label="r")
+        child = model.tree.create(label="c", parent=root)
+        model.tree.create(label="d", parent=child)
+        return root, child, model.tree.create(label="o")
+
+    @staticmethod
+    def labels(nodes):
+        """Sorted labels of nodes"""
+        return sorted(node.label for node in nodes)
+
+    def test_cached(self):
+        """Traversals are computed once"""
+        root = self.create_chain(CachedDirectory)[0]
+        self.assertEqual(self.labels(root.get_descendants()), ["c", "d"])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.labels(root.get_descendants()), ["c", "d"])
+
+    def test_move_in_transaction(self):
+        """A move is seen by the rest of its transaction"""
+        for model in (CachedDirectory, CachedFolder):
+            root, child, other = self.create_chain(model)
+            self.assertEqual(self.labels(root.get_descendants()), ["c", "d"])
+            with transaction.atomic():
+                child.move_subtree(other)
+                self.assertEqual(self.labels(root.get_descendants()), [])
+                self.assertEqual(self.labels(other.get_descendants()), ["c", "d"])
+            self.assertEqual(self.labels(other.get_descendants()), ["c", "d"])
+
+    def test_queryset_writes(self):
+        """QuerySet.update() and QuerySet.delete() invalidate traversals"""
+        root, child, other = self.create_chain(CachedDirectory)
+        self.assertEqual(self.labels(root.get_descendants()), ["c", "d"])
+        CachedDirectory.tree.filter(pk=child.pk).update(parent=other)
+        self.assertEqual(self.labels(root.get_descendants()), [])
+        self.assertEqual(self.labels(other.get_descendants()), ["c", "d"])
+        CachedDirectory.tree.filter(label="d").delete()
+        self.assertEqual(self.labels(other.get_descendants()), ["c"])
+
+    def test_rebuild_paths(self):
+        """Rebuilding paths after bulk writes invalidates traversals"""
+        root = self.create_chain(CachedFolder)[0]
+        self.assertEqual(self.labels(root.get_descendants()), ["c", "d"])
+        CachedFolder.tree.bulk_create([CachedFolder(label="e", parent=root)])
+        CachedFolder.tree.rebuild_paths()
+        self.assertEqual(self.labels(root.get_descendants()), ["c", "d", "e"])
+
+
+class UniquePathCacheTestCase(TestModelsMixin, TransactionTestCase):
+    """Stored unique paths are emptied when a subtree moves"""
+
+    models = (Category,)
+
+    def test_move_subtree(self):
+        """The moved node and its descendants get their new paths"""
+        root = Category.tree.create(label="r")
+        other = Category.tree.create(label="r2")
+        node = Category.tree.create(label="s", parent=root)
+        leaf = Category.tree.create(label="t", parent=node)
+        self.assertEqual(Category.get_unique_paths([node, leaf]), {node.pk: "r / s", leaf.pk: "r / s / t"})
+        node.move_subtree(other)
+        node, leaf = Category.tree.get(pk=node.pk), Category.tree.get(pk=leaf.pk)
+        self.assertIsNone(node.unique_path)
+        self.assertEqual(node.get_unique_path(), "r2 / s")
+        self.assertEqual(leaf.get_unique_path(), "r2 / s / t")
+        self.assertEqual(Category.tree.get(pk=node.pk).unique_path, "r2 / s")
+
+
+class SubtreeStatementsTestCase(TestModelsMixin, TransactionTestCase):
+    """Moving or deleting a subtree costs the same whatever its size"""
+
+    models = (Directory, Folder)
+
+    def build(self, model, size):
+        """A root with size descendants, on a few levels"""
+        root = parent = model.tree.create(label="root")
+        for index in range(size):
+            node = model.tree.create(label="n{}".format(index), parent=parent)
+            if index % 5 == 0:
+                parent = node
+        return root
+
+    def count_statements(self, action):
+        """Number of statements run by an action"""
+        with CaptureQueriesContext(connection) as context:
+            action()
+        return len(context)
+
+    def test_move_subtree(self):
+        """move_subtree runs a fixed number of statements"""
+        for model in self.models:
+            with self.subTest(model=model.__name__):
+                targets = [model.tree.create(label="target") for _ in range(2)]
+                small, large = self.build(model, 5), self.build(model, 60)
+                self.assertEqual(
+                    self.count_statements(lambda: small.move_subtree(targets[0])),
+                    self.count_statements(lambda: large.move_subtree(targets[1])),
+                )
+                self.assertEqual(model.tree.descendants_of(targets[1]).count(), 61)
+
+    def test_delete_subtree(self):
+        """delete_subtree runs a fixed number of statements"""
+        for model in self.models:
+            with self.subTest(model=model.__name__):
+                small, large = self.build(model, 5), self.build(model, 60)
+                self.assertEqual(
+                    self.count_statements(small.delete_subtree),
+                    self.count_statements(large.delete_subtree),
+                )
+                self.assertFalse(model.tree.exists())
+
+
+class MaterializedPathTestCase(TestModelsMixin, TransactionTestCase):
+    """Paths and depths follow saves, moves and bulk writes"""
+
+    models = (Folder,)
+
+    def setUp(self):
+        self.root = Folder.tree.create(label="root")
+        self.other = Folder.tree.create(label="other")
+        self.child = Folder.tree.create(label="child", parent=self.root)
+        self.leaf = Folder.tree.create(label="leaf", parent=self.child)
+
+    def assertPath(self, node, *ancestors):  # pylint: disable=invalid-name
+        """The stored path and depth of node match its ancestors"""
+        node = Folder.tree.get(pk=node.pk)
+        self.assertEqual(node.path, "".join("{}/".format(item.pk) for item in ancestors + (node,)))
+        self.assertEqual(node.depth, len(ancestors))
+
+    def test_paths_on_create(self):
+        """Paths are built from the parent path"""
+        self.assertPath(self.root)
+        self.assertPath(self.leaf, self.root, self.child)
+        self.assertEqual(set(self.root.get_descendants()), {self.child, self.leaf})
+        self.assertEqual(list(self.leaf.get_ancestors()), [self.root, self.child])
+
+    def test_move_rewrites_subtree(self):
+        """Moving a node rewrites the path and depth of its whole subtree"""
+        middle = Folder.tree.create(label="middle", parent=self.other)
+        self.child.move_subtree(middle)
+        self.assertPath(self.child, self.other, middle)
+        self.assertPath(self.leaf, self.other, middle, self.child)
+        self.assertEqual(set(self.root.get_descendants()), set())
+        self.child.move_subtree(None)
+        self.assertPath(self.child)
+        self.assertPath(self.leaf, self.child)
+        self.assertPath(middle, self.other)
+
+    def test_too_deep(self):
+        """Nodes whose path would not fit are refused, and nothing is saved"""
+        parent = self.leaf
+        with self.assertRaises(ValidationError):
+            for index in range(100):
+                parent = Folder.tree.create(label="deep {}".format(index), parent=parent)
+        deepest = Folder.tree.order_by("-depth").first()
+        with self.assertRaises(ValidationError):
+            self.child.move_subtree(deepest)
+        self.assertPath(self.leaf, self.root, self.child)
+
+    def test_bulk_writes(self):
+        """Nodes without path are refused by lookups until paths are rebuilt"""
+        Folder.tree.bulk_create([Folder(label="bulk", parent=self.other)])
+        bulk = Folder.tree.get(label="bulk")
+        Folder.tree.filter(pk=self.child.pk).update(parent=self.other)
+        with self.assertRaises(ValueError):
+            bulk.get_descendants()
+        with self.assertRaises(ValueError):
+            bulk.delete_subtree()
+        self.assertEqual(Folder.tree.count(), 5)
+        self.assertEqual(Folder.tree.rebuild_paths(), 3)
+        self.assertEqual(Folder.tree.rebuild_paths(), 0)
+        self.assertPath(bulk, self.other)
+        self.assertPath(self.leaf, self.other, self.child)
+        self.assertEqual(set(Folder.tree.get(pk=bulk.pk).get_descendants()), set())
+
+
+class StatusTestCase(TestModelsMixin, TransactionTestCase):
+    """Statuses, transitions and counters of StatusMixin models"""
+
+    models = (Ticket, UrgentTicket)
+
+    def setUp(self):
+        super().setUp()
+        status_registry.invalidate()
+        self.open = Status.objects.create(model="util.ticket", label="open", is_default=True)
+        self.closed = Status.objects.create(model="util.ticket", label="closed")
+
+    def tearDown(self):
+        super().tearDown()
+        status_registry.invalidate()
+
+    def test_default_status_of_child(self):
+        """A child model uses the statuses of the model owning the field"""
+        self.assertEqual(UrgentTicket.get_default_status(), self.open)
+        self.assertEqual(UrgentTicket.objects.create(label="a").status, self.open)
+
+    def test_transition(self):
+        """Validated rows are changed with one UPDATE and recorded in the history"""
+        tickets = [Ticket.objects.create(label=str(number)) for number in range(3)]
+        with CaptureQueriesContext(connection) as queries:
+            changed = Ticket.transition(Ticket.objects.filter(label__in=["0", "1"]), "closed")
+        self.assertEqual(changed, 2)
+        updates = [query["sql"] for query in queries if query["sql"].startswith('UPDATE "util_ticket"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(
+            dict(Ticket.objects.values_list("label", "status")),
+            {"0": self.closed.pk, "1": self.closed.pk, "2": self.open.pk},
+        )
+        self.assertEqual(
+            sorted(StatusTransition.objects.values_list("model", "object_id", "from_status", "to_status")),
+            [("util.ticket", ticket.pk, self.open.pk, self.closed.pk) for ticket in tickets[:2]],
+        )
+
+    def test_transition_rejected(self):
+        """Undeclared transitions change nothing"""
+        Ticket.objects.create(label="a", status=self.closed)
+        with self.assertRaises(ValidationError):
+            Ticket.transition(Ticket.objects.all(), "open")
+        self.assertEqual(Ticket.objects.get().status, self.closed)
+        self.assertFalse(StatusTransition.objects.exists())
+
+    def test_counters(self):
+        """Counters follow creations, status changes, deletions and transitions"""
+        first, second, third = (Ticket.objects.create(label=str(number)) for number in range(3))
+        urgent = UrgentTicket.objects.create(label="urgent")
+        self.assertEqual(Ticket.get_status_counts(), {"open": 4, "closed": 0})
+        first.status = self.closed
+        first.save()
+        second.label = "renamed"
+        second.save()
+        self.assertEqual(Ticket.get_status_counts(), {"open": 3, "closed": 1})
+        urgent.delete()
+        first.delete()
+        self.assertEqual(Ticket.get_status_counts(), {"open": 2, "closed": 0})
+        Ticket.transition(Ticket.objects.filter(pk=third.pk), "closed")
+        self.assertEqual(Ticket.get_status_counts(), {"open": 1, "closed": 1})
+
+    def test_rebuild_status_counters(self):
+        """Counters are rebuilt from scratch, aggregating one chunk per query"""
+        for number in range(5):
+            Ticket.objects.create(label=str(number), status=self.closed if number % 2 else self.open)
+        StatusCounter.objects.filter(status=self.open).update(count=42)
+        StatusCounter.objects.filter(status=self.closed).delete()
+        output = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command("rebuild_status_counters", "util.Ticket", chunk_size=2, stdout=output)
+        self.assertEqual(output.getvalue(), "util.ticket: 5 objects in 2 statuses\n")
+        self.assertEqual(Ticket.get_status_counts(), {"open": 3, "closed": 2})
+        self.assertEqual(len([query for query in queries if "GROUP BY" in query["sql"]]), 3)
+
+    def test_rebuild_status_counters_refuses_models_not_counting(self):
+        """Only models counting statuses can be rebuilt"""
+        with self.assertRaises(CommandError):
+            call_command("rebuild_status_counters", "util.Status", stdout=StringIO())
+
+
+class LoadReferenceDataTestCase(TransactionTestCase):
+    """Bulk upsert of reference data"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def tearDown(self):
+        super().tearDown()
+        reference_registry.invalidate()
+
+    def load(self, *files):
+        """Run the command, returning its output lines"""
+        output = StringIO()
+        call_command("load_reference_data", *files, batch_size=100, stdout=output)
+        return output.getvalue().splitlines()
+
+    def write(self, name, content):
+        """Write a file to load, returning its path"""
+        path = Path(self.directory.name) / name
+        path.write_text(content, encoding="utf-8")
+        return str(path)
+
+    def test_idempotent(self):
+        """Loading the same data twice changes nothing"""
+        first = self.load()
+        self.assertIn("states.csv: 126 created, 0 updated", first)
+        second = self.load()
+        self.assertEqual(len(second), len(first))
+        for line in second:
+            self.assertTrue(line.endswith(": 0 created, 0 updated"), line)
+
+    def test_update(self):
+        """Rows matching an existing natural key are updated"""
+        self.load()
+        units = self.write("units.csv", "category__name,label,plural,symbol,value\n"
+                                        "mass,ton,tons,t,1001\n"
+                                        "mass,kilogram,kilograms,kg,1\n")
+        self.assertEqual(self.load(units), ["units.csv: 0 created, 1 updated"])
+        self.assertEqual(Unit.objects.get(label="ton").value, 1001)
+
+    def test_foreign_key_aliases(self):
+        """Related rows are found through the aliased lookup"""
+        self.load()
+        state = State.objects.select_related("country", "category").get(code="US_AK")
+        self.assertEqual((state.country.alpha2, state.category.label), ("US", "state"))
+
+    def test_unknown_foreign_key(self):
+        """Rows pointing to missing related rows are refused"""
+        units = self.write("units.csv", "category__name,label,plural,symbol,value\nlength,metre,metres,m,1\n")
+        with self.assertRaisesMessage(CommandError, "unknown category__label 'length'"):
+            self.load(units)
+
+    def test_malformed_row(self):
+        """Rows without the columns of the header are refused with their line"""
+        locales = self.write("locales.csv", "label\nfr-fr\nen-us,extra\n")
+        with self.assertRaisesMessage(CommandError, "locales.csv, line 3: malformed row"):
+            self.load(locales)
+
+
+class UnitConverterTestCase(TransactionTestCase):
+    """Unit conversions with factors read from memory"""
+
+    def setUp(self):
+        super().setUp()
+        reference_registry.invalidate()
+        mass = UnitCategory.objects.create(label="mass")
+        length = UnitCategory.objects.create(label="length")
+        self.kilogram = Unit.objects.create(category=mass, label="kilogram", plural="kilograms", symbol="kg", value=1)
+        self.ton = Unit.objects.create(category=mass, label="ton", plural="tons", symbol="t", value=1000)
+        self.gram = Unit.objects.create(category=mass, label="gram", plural="grams", symbol="g", value=0.001)
+        self.metre = Unit.objects.create(category=length, label="metre", plural="metres", symbol="m", value=1)
+        self.converter = conversion.UnitConverter()
+
+    def tearDown(self):
+        super().tearDown()
+        reference_registry.invalidate()
+
+    def check_conversions(self):
+        """Convert single amounts, sequences and amounts in mixed units"""
+        self.assertEqual(self.converter.get_factor(self.ton, self.kilogram.pk), 1000)
+        self.assertEqual(self.converter.convert(2, self.ton.pk, self.kilogram), 2000)
+        self.assertEqual(list(self.converter.convert_many([1, 2.5], self.kilogram, self.ton)), [0.001, 0.0025])
+        self.assertEqual(
+            list(self.converter.convert_mixed([1, 2, 3000], [self.ton, self.kilogram.pk, self.gram], self.kilogram)),
+            [1000, 2, 3],
+        )
+        with self.assertRaises(conversion.IncompatibleUnits):
+            self.converter.convert(1, self.metre, self.kilogram)
+        with self.assertRaises(conversion.IncompatibleUnits):
+            self.converter.convert_mixed([1, 2], [self.ton, self.metre], self.kilogram)
+
+    @skipUnless(conversion.numpy is not None, "NumPy is not installed")
+    def test_numpy(self):
+        """Conversions with vectorized operations"""
+        self.check_conversions()
+        from_units = conversion.numpy.array([self.ton.pk, self.gram.pk] * 500)
+        result = self.converter.convert_mixed(conversion.numpy.ones(1000), from_units, self.kilogram)
+        self.assertEqual(result.tolist(), [1000, 0.001] * 500)
+
+    def test_pure_python(self):
+        """Conversions without NumPy"""
+        with patch.object(conversion, "numpy", None):
+            self.check_conversions()
+
+    def test_units_reloaded(self):
+        """Changed factors are used once the unit is saved"""
+        self.assertEqual(self.converter.convert(1, self.ton, self.kilogram), 1000)
+        self.ton.value = 907.18474
+        self.ton.save()
+        self.assertEqual(self.converter.convert(1, self.ton, self.kilogram), 907.18474)
+
+
+class CurrencyConverterTestCase(TransactionTestCase):
+    """Currency conversions with the rates in effect at given dates"""
+
+    def setUp(self):
+        super().setUp()
+        self.euro = Currency.objects.create(label="euro", plural="euros", symbol="€", iso_code="EUR", value=1)
+        self.dollar = Currency.objects.create(label="dollar", plural="dollars", symbol="$", iso_code="USD")
+        CurrencyRate.time_framed_objects.create(currency=self.euro, start=make_aware(datetime(2000, 1, 1)), value=1)
+        CurrencyRate.time_framed_objects.create(currency=self.dollar, start=make_aware(datetime(2020, 1, 1)),
+                                                end=make_aware(datetime(2021, 1, 1)), value=1.25)
+        CurrencyRate.time_framed_objects.create(currency=self.dollar, start=make_aware(datetime(2021, 1, 1)), value=0.8)
+        self.converter = conversion.CurrencyConverter()
+
+    def check_conversions(self):
+        """Convert with dates, naive and aware datetimes, and period bounds"""
+        self.assertEqual(
+            list(self.converter.convert_many(
+                [10, 10, 10, 10],
+                [self.dollar, self.dollar.pk, self.dollar, self.euro],
+                [date(2020, 6, 1), datetime(2020, 12, 31, 23), make_aware(datetime(2021, 1, 1)), date(2020, 6, 1)],
+            )),
+            [8, 8, 12.5, 10],
+        )
+        self.assertEqual(self.converter.convert(10, self.euro, date(2021, 6, 1), self.dollar), 8)
+        self.assertEqual(list(self.converter.convert_many([], [], [])), [])
+        with self.assertRaises(conversion.MissingRate):
+            self.converter.convert(10, self.dollar, date(2019, 12, 31))
+        with self.assertRaises(TypeError):
+            self.converter.convert(10, self.dollar, "2020-06-01")
+
+    @skipUnless(conversion.numpy is not None, "NumPy is not installed")
+    def test_numpy(self):
+        """Conversions with vectorized lookups"""
+        self.check_conversions()
+
+    def test_pure_python(self):
+        """Conversions without NumPy"""
+        with patch.object(conversion, "numpy", None):
+            self.check_conversions()
+
+
+class LocalisationTestCase(TestModelsMixin, TransactionTestCase):
+    """Addresses compiled in Python and by the database"""
+
+    models = (Site, Office)
+
+    def setUp(self):
+        super().setUp()
+        reference_registry.invalidate()
+        self.country = Country.objects.create(
+            label="États-Unis", alpha2="US", alpha3="USA", number=840,
+            name_fr="ÉTATS-UNIS", name_en="UNITED STATES", usage="United States",
+        )
+        category = StateCategory.objects.create(label="state", plural="states")
+        self.state = State.objects.create(label="Alaska", code="US_AK", country=self.country, category=category)
+
+    def tearDown(self):
+        super().tearDown()
+        reference_registry.invalidate()
+
+    def test_default_manager(self):
+        """objects stays the default manager of localised models"""
+        self.assertEqual(Site._meta.default_manager.name, "objects")  # pylint: disable=protected-access
+        self.assertEqual(Site.objects.count(), 0)
+
+    def test_with_address(self):
+        """with_address compiles the same addresses as the address property, in one query"""
+        common = {"address1": "1 Main Street", "zip": "99501", "city": "Anchorage", "country": self.country}
+        Site.objects.create(label="full", address2="Suite 2", state=self.state, **common)
+        Site.objects.create(label="no state", address2="", **common)
+        Site.objects.create(label="no address2", address2=None, state=self.state, **common)
+        expected = {site.label: site.address for site in Site.objects.all()}
+        self.assertEqual(expected["full"], "1 Main Street\nSuite 2\n99501 Anchorage Alaska\nÉtats-Unis")
+        self.assertEqual(expected["no state"], "1 Main Street\n99501 Anchorage\nÉtats-Unis")
+        with self.assertNumQueries(1):
+            found = {site.label: site.rendered_address for site in Site.localised_objects.with_address()}
+        self.assertEqual(found, expected)
+
+    def create_office(self, label, **kwargs):
+        """Office in Anchorage"""
+        values = {"address1": "1 Main Street", "zip": "99501", "city": "Anchorage", "country": self.country}
+        values.update(kwargs)
+        return Office.objects.create(label=label, **values)
+
+    def stored_addresses(self):
+        """Stored addresses, by label"""
+        return dict(Office.objects.values_list("label", "full_address"))
+
+    def test_full_address_saved(self):
+        """The address is compiled from the fields on save"""
+        self.create_office("a", state=self.state)
+        self.assertEqual(self.stored_addresses(), {"a": "1 Main Street\n99501 Anchorage Alaska\nÉtats-Unis"})
+        office = Office.localised_objects.with_address().get()
+        office.city = "Juneau"
+        office.save()
+        self.assertEqual(office.address, "1 Main Street\n99501 Juneau Alaska\nÉtats-Unis")
+        self.assertEqual(self.stored_addresses(), {"a": office.address})
+
+    def test_full_address_saved_with_update_fields(self):
+        """Saving some fields also saves the compiled address"""
+        office = self.create_office("a")
+        office.zip = "99502"
+        office.save(update_fields=["zip"])
+        self.assertEqual(self.stored_addresses(), {"a": "1 Main Street\n99502 Anchorage\nÉtats-Unis"})
+
+    def test_refresh_addresses(self):
+        """Renamed countries are applied to the stored addresses in bulk"""
+        for label in "abc":
+            self.create_office(label, state=self.state if label == "a" else None)
+        Country.objects.filter(pk=self.country.pk).update(label="USA")
+        Office.refresh_addresses(batch_size=2)
+        self.assertEqual(self.stored_addresses(), {
+            "a": "1 Main Street\n99501 Anchorage Alaska\nUSA",
+            "b": "1 Main Street\n99501 Anchorage\nUSA",
+            "c": "1 Main Street\n99501 Anchorage\nUSA",
+        })
+
+
+class ReferenceRegistryTestCase(TestModelsMixin, TransactionTestCase):
+    """Reference rows are read from memory, and never shared with callers"""
+
+    models = (Site, Office)
+
+    def setUp(self):
+        super().setUp()
+        reference_registry.invalidate()
+        self.country = Country.objects.create(
+            label="États-Unis", alpha2="US", alpha3="USA", number=840,
+            name_fr="ÉTATS-UNIS", name_en="UNITED STATES", usage="United States",
+        )
+        category = StateCategory.objects.create(label="state", plural="states")
+        self.state = State.objects.create(label="Alaska", code="US_AK", country=self.country, category=category)
+        common = {"address1": "1 Main Street", "zip": "99501", "city": "Anchorage", "country": self.country}
+        Site.objects.create(label="a", state=self.state, **common)
+        Site.objects.create(label="b", state=self.state, **common)
+
+    def tearDown(self):
+        super().tearDown()
+        reference_registry.invalidate()
+
+    def test_loaded_once(self):
+        """A table is loaded with one query, then foreign keys need none"""
+        sites = list(Site.objects.order_by("label"))
+        with self.assertNumQueries(2):  # countries, states with their relations
+            self.assertEqual([site.country.label for site in sites], ["États-Unis"] * 2)
+            self.assertEqual([site.state.country.alpha2 for site in sites], ["US"] * 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(reference_registry.get_by(Country, "alpha3", "USA").pk, self.country.pk)
+            self.assertEqual(reference_registry.get_by(State, "code", "US_AK").label, "Alaska")
+
+    def test_unknown(self):
+        """Unknown primary keys and codes raise DoesNotExist"""
+        with self.assertRaises(Country.DoesNotExist):
+            reference_registry.get(Country, self.country.pk + 1)
+        with self.assertRaises(State.DoesNotExist):
+            reference_registry.get_by(State, "code", "US_XX")
+
+    def test_rows_not_shared(self):
+        """Modifying a related row changes neither other objects nor the registry"""
+        first, second = Site.objects.order_by("label")
+        first.country.label = "changed"
+        first.state.country.label = "changed"
+        self.assertEqual(second.country.label, "États-Unis")
+        self.assertEqual(second.state.country.label, "États-Unis")
+        self.assertEqual(reference_registry.get(Country, self.country.pk).label, "États-Unis")
+        self.assertEqual(reference_registry.get_by(State, "code", "US_AK").country.label, "États-Unis")
+        self.assertEqual(first.country.label, "changed")
+
+    def test_reloaded_on_save(self):
+        """Saved and deleted rows are reloaded on next use"""
+        self.assertEqual(reference_registry.get(Country, self.country.pk).label, "États-Unis")
+        self.country.label = "USA"
+        self.country.save()
+        self.assertEqual(Site.objects.first().country.label, "USA")
+        Site.objects.all().delete()
+        self.state.delete()
+        with self.assertRaises(State.DoesNotExist):
+            reference_registry.get_by(State, "code", "US_AK")
@@ -0,0 +1,523 @@
+"""
+Time framed objects.
+
+An object is in effect at a date when start <= date < end: periods are
+half-open, and a null end means the period is still open. Contiguous periods
+([a, b) then [b, c)) never overlap.
+
+Periods cached in memory are invalidated through model signals, in the
+process saving the object. When the UTIL_PERIOD_CACHE setting names a cache
+alias, invalidations are also shared between workers through a version
+counter stored in that cache.
+
+Kept apart from util.mixins so that util.models can use them.
+"""
+
+from collections import defaultdict, namedtuple
+from heapq import heappop, heappush
+from itertools import count
+from time import monotonic
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.db import router, transaction
+from django.db.backends.utils import names_digest
+from django.db.models import (
+    signals,
+    QuerySet,
+    Manager,
+    Model,
+    DateTimeField,
+    Index,
+    Min,
+    Q)
+from django.db.migrations.operations.base import Operation
+from django.dispatch import receiver
+from django.utils.timezone import now
+from django.utils.translation import ugettext_lazy as _
+
+
+def in_effect_at_filter(date, prefix=""):
+    """
+    Condition matching objects in effect at a date.
+
+    Written as two branches so that each one can use an index: (end, start)
+    for closed periods, and start for open ones.
+    """
+    start, end = prefix + "start", prefix + "end"
+    return (
+        Q(**{start + "__lte": date, end + "__gt": date})
+        | Q(**{start + "__lte": date, end + "__isnull": True})
+    )
+
+
+def _end_key(end):
+    """Sortable end of a period, open periods ending after any date"""
+    return (1,) if end is None else (0, end)
+
+
+class PeriodTree:
+    """
+    Static interval tree of time framed objects.
+
+    Objects are sorted by start and form an implicit balanced tree, each node
+    knowing the latest end of its subtree. A stabbing query only visits the
+    subtrees that may hold matches: O(log n) per object found.
+    """
+
+    def __init__(self, objects):
+        self.objects = sorted(objects, key=lambda obj: obj.start)
+        self.starts = [obj.start for obj in self.objects]
+        self.ends = [_end_key(obj.end) for obj in self.objects]
+        self.max_ends = [None] * len(self.objects)
+        self.created = monotonic()
+        self.version = None
+        self._build(0, len(self.objects))
+
+    def __len__(self):
+        return len(self.objects)
+
+    def _build(self, low, high):
+        """Compute the latest end of the subtree covering objects[low:high]"""
+        if low >= high:
+            return (0,)
+        middle = (low + high) // 2
+        self.max_ends[middle] = max(self.ends[middle], self._build(low, middle), self._build(middle + 1, high))
+        return self.max_ends[middle]
+
+    def _collect(self, low, high, after, before, result):
+        """Objects of objects[low:high] starting before "before" and ending after "after" """
+        if low >= high:
+            return
+        middle = (low + high) // 2
+        if self.max_ends[middle] <= after:
+            return
+        self._collect(low, middle, after, before, result)
+        if before(self.starts[middle]):
+            if self.ends[middle] > after:
+                result.append(self.objects[middle])
+            self._collect(middle + 1, high, after, before, result)
+
+    def at(self, date):
+        """Objects in effect at a date, sorted by start"""
+        result = []
+        self._collect(0, len(self.objects), (0, date), lambda start: start <= date, result)
+        return result
+
+    def overlapping(self, start, end=None):
+        """Objects in effect at some point of [start, end), sorted by start"""
+        result = []
+        before = (lambda value: True) if end is None else (lambda value: value < end)
+        self._collect(0, len(self.objects), (0, start), before, result)
+        return result
+
+
+def find_overlapping_periods(objects):
+    """
+    Overlapping (object, object) pairs among periods sharing the same key.
+
+    Sweep line over the periods sorted by start: a period overlaps the one
+    ending last among those started before it, if it starts before that
+    end. O(n log n); each overlapping period is reported at least once.
+    """
+    overlaps = []
+    latest = None
+    for obj in sorted(objects, key=lambda obj: (obj.start, _end_key(obj.end))):
+        if latest is not None and _end_key(latest.end) > (0, obj.start):
+            overlaps.append((latest, obj))
+        if latest is None or _end_key(obj.end) > _end_key(latest.end):
+            latest = obj
+    return overlaps
+
+
+# Objects in effect when computed, valid until the next start or end
+CurrentPeriods = namedtuple("CurrentPeriods", ("ids", "until", "created", "version"))
+
+# Cached PeriodTree and CurrentPeriods of each (model, manager name, database alias)
+_period_trees = {}
+_current_periods = {}
+
+
+def _shared_cache():
+    """Cache sharing invalidations between workers, if any"""
+    alias = getattr(settings, "UTIL_PERIOD_CACHE", None)
+    return caches[alias] if alias else None
+
+
+def _version_key(model):
+    """Key of the shared version counter of the periods of a model"""
+    return "util.periods.{}.version".format(model._meta.concrete_model._meta.label_lower)
+
+
+def get_periods_version(model):
+    """Shared version of the periods of a model, None without shared cache"""
+    cache = _shared_cache()
+    if cache is None:
+        return None
+    key = _version_key(model)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 1, timeout=None)
+        version = cache.get(key, 1)
+    return version
+
+
+def invalidate_periods(model, using=None):
+    """Forget the cached periods of a model (in one database, or in all of them), in all workers"""
+    for cache in (_period_trees, _current_periods):
+        for key in list(cache):
+            if key[0]._meta.concrete_model is model._meta.concrete_model and using in (None, key[2]):
+                cache.pop(key, None)
+    shared = _shared_cache()
+    if shared is not None:
+        try:
+            shared.incr(_version_key(model))
+        except ValueError:
+            shared.add(_version_key(model), 1, timeout=None)
+
+
+class TimeFramedQuerySet(QuerySet):
+    """QuerySet used by BaseMixin models"""
+
+    def in_effect(self):
+        """Allow to find an object that is currently valid"""
+        return self.in_effect_at(now())
+
+    def in_effect_at(self, date):
+        """Allow to find an object that is valid at a specific date"""
+        return self.filter(in_effect_at_filter(date))
+
+    def in_effect_at_many(self, dates):
+        """
+        Yield (date, object) pairs of the objects in effect at each date.
+
+        Objects overlapping the dates are read with a single query, sorted by
+        start, and swept along the sorted dates: the cost grows with the
+        output, not with dates x rows. Pairs are ordered by date, then start.
+        """
+        dates = sorted(set(dates))
+        if not dates:
+            return
+        queryset = (
+            self.filter(start__lte=dates[-1])
+            .filter(Q(end__gt=dates[0]) | Q(end__isnull=True))
+            .order_by("start")
+        )
+        rows = queryset.iterator()
+        pending = next(rows, None)
+        active, ends, keys = {}, [], count()
+        for date in dates:
+            while pending is not None and pending.start <= date:
+                if pending.end is None or pending.end > date:
+                    key = next(keys)
+                    active[key] = pending
+                    if pending.end is not None:
+                        heappush(ends, (pending.end, key))
+                pending = next(rows, None)
+            while ends and ends[0][0] <= date:
+                del active[heappop(ends)[1]]
+            for obj in active.values():
+                yield date, obj
+
+
+class TimeFramedManager(Manager):
+    """Manager for Models using the Time Framed Mixin"""
+
+    def _get_queryset(self):
+        """Link to the query set"""
+        return TimeFramedQuerySet(self.model, using=self._db)
+
+    def get_queryset(self):
+        """Return the query set"""
+        return self._get_queryset()
+
+    @property
+    def in_effect(self):
+        """Get only active objects"""
+        return self.get_queryset().in_effect()
+
+    def in_effect_at(self, date):
+        """Get only active objects"""
+        return self.get_queryset().in_effect_at(date)
+
+    def in_effect_at_many(self, dates):
+        """Get the objects active at each date, as (date, object) pairs"""
+        return self.get_queryset().in_effect_at_many(dates)
+
+    def invalidate_periods(self, using=None):
+        """Forget cached periods (of one database, or of all of them)"""
+        invalidate_periods(self.model, using)
+
+    def get_period_tree(self):
+        """
+        Interval tree of all the objects, loaded once per process.
+
+        Only cached for models setting cache_periods. The cache is cleared
+        when an object is saved or deleted (not by bulk updates): in this
+        process, and in the others through UTIL_PERIOD_CACHE. Without it,
+        period_cache_timeout bounds how long other processes may keep stale
+        periods.
+        """
+        if not self.model.cache_periods:
+            return PeriodTree(self.get_queryset())
+        key = (self.model, self.name, self.db)
+        tree = _period_trees.get(key)
+        version = get_periods_version(self.model)
+        timeout = self.model.period_cache_timeout
+        if (tree is None or tree.version != version
+                or (timeout is not None and monotonic() - tree.created > timeout)):
+            tree = _period_trees[key] = PeriodTree(self.get_queryset())
+            tree.version = version
+        return tree
+
+    def get_current_periods(self):
+        """
+        Primary keys of the objects currently in effect.
+
+        Only cached for models setting track_current_periods: the ids are
+        computed with the next boundary (earliest start or end to come), and
+        kept until the clock reaches it or an object is saved or deleted
+        (see get_period_tree for other processes).
+        """
+        key = (self.model, self.name, self.db)
+        current = _current_periods.get(key)
+        date = now()
+        version = get_periods_version(self.model)
+        timeout = self.model.period_cache_timeout
+        if (current is None or current.version != version
+                or (current.until is not None and date >= current.until)
+                or (timeout is not None and monotonic() - current.created > timeout)):
+            queryset = self.get_queryset()
+            boundaries = queryset.aggregate(
+                start=Min("start", filter=Q(start__gt=date)),
+                end=Min("end", filter=Q(end__gt=date)),
+            )
+            boundaries = [boundary for boundary in boundaries.values() if boundary is not None]
+            current = CurrentPeriods(
+                frozenset(queryset.in_effect_at(date).values_list("pk", flat=True)),
+                min(boundaries) if boundaries else None,
+                monotonic(),
+                version,
+            )
+            if self.model.track_current_periods:
+                _current_periods[key] = current
+        return current
+
+    def current_ids(self):
+        """Primary keys of the objects currently in effect"""
+        return self.get_current_periods().ids
+
+    @property
+    def cached_in_effect(self):
+        """Get only active objects, found from the cached ids"""
+        return self.get_queryset().filter(pk__in=self.current_ids())
+
+    def cached_in_effect_at(self, date):
+        """Objects active at a date, from the period cache"""
+        return self.get_period_tree().at(date)
+
+    def cached_overlapping(self, start, end=None):
+        """Objects active at some point of [start, end), from the period cache"""
+        return self.get_period_tree().overlapping(start, end)
+
+
+class TimeFramedMixin(Model):
+    """Must be inherited by models that are valid only in a period of time"""
+
+    #
+    # Embedded QuerySet
+    #
+
+    class QuerySet(TimeFramedQuerySet):
+        """Base QuerySet used by BaseMixin models that does not overwrite it"""
+
+    # same default filters as BaseManager, with some other filters added
+    time_framed_objects = TimeFramedManager()
+
+    # Add the indexes used by in_effect_at to concrete models
+    time_framed_indexes = True
+
+    # Keep all the periods in memory (see TimeFramedManager.get_period_tree)
+    cache_periods = False
+    period_cache_timeout = 300  # seconds, None to keep the periods until invalidated
+
+    # Cache the ids in effect until the next boundary (see TimeFramedManager.get_current_periods)
+    track_current_periods = False
+
+    # Fields of the objects whose periods must not overlap, e.g. ("currency",)
+    period_key = None
+
+    #
+    # Define valid period
+    #
+
+    start = DateTimeField(
+        verbose_name=_("start on"),
+        blank=False,
+        editable=True,  # TODO: Think about that
+    )
+
+    end = DateTimeField(
+        verbose_name=_("end on"),
+        null=True,
+        blank=True,
+        editable=True,  # TODO: Think about that
+    )
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """TimeFramedMixin Meta class"""
+
+        abstract = True
+
+    @classmethod
+    def find_overlaps(cls, objects, using=None):
+        """
+        Overlapping (object, object) pairs among objects and stored rows.
+
+        Objects are grouped by period_key, and each group is checked against
+        the rows stored in the database with a single range query. Stored
+        rows replaced by one of the objects (same primary key) are ignored.
+        """
+        if cls.period_key is None:
+            return []
+        attnames = [cls._meta.get_field(name).attname for name in cls.period_key]
+        groups = defaultdict(list)
+        for obj in objects:
+            groups[tuple(getattr(obj, attname) for attname in attnames)].append(obj)
+        using = using or router.db_for_read(cls)
+        overlaps = []
+        for key, group in groups.items():
+            starts = min(obj.start for obj in group)
+            ends = max(_end_key(obj.end) for obj in group)
+            stored = (
+                cls._base_manager.using(using)
+                .filter(**dict(zip(attnames, key)))
+                .filter(Q(end__gt=starts) | Q(end__isnull=True))
+                .exclude(pk__in=[obj.pk for obj in group if obj.pk is not None])
+            )
+            if ends != (1,):
+                stored = stored.filter(start__lt=ends[1])
+            overlaps.extend(find_overlapping_periods(group + list(stored)))
+        return overlaps
+
+    @classmethod
+    def check_periods(cls, objects, using=None):
+        """Ensure that the periods of objects overlap neither each other nor stored rows"""
+        overlaps = cls.find_overlaps(objects, using)
+        if overlaps:
+            raise ValidationError([
+                ValidationError(
+                    _("Period [%(start)s, %(end)s) overlaps period [%(other_start)s, %(other_end)s)."),
+                    code="overlap",
+                    params={
+                        "start": second.start, "end": second.end or "",
+                        "other_start": first.start, "other_end": first.end or "",
+                    },
+                )
+                for first, second in overlaps
+            ])
+
+    def clean(self):
+        """Validate that the period is not empty and overlaps no other one"""
+        super().clean()
+        if self.end is not None and self.start is not None and self.end <= self.start:
+            raise ValidationError({"end": _("A period must end after its start.")}, code="period")
+        if self.start is not None:
+            self.check_periods([self], using=self._state.db)
+
+
+class ConditionalIndex(Index):
+    """Partial index, created as a plain index by backends lacking them"""
+
+    def create_sql(self, model, schema_editor, using=""):
+        if schema_editor.connection.features.supports_partial_indexes:
+            return super().create_sql(model, schema_editor, using=using)
+        fields = [model._meta.get_field(field_name) for field_name, _order in self.fields_orders]
+        return schema_editor._create_index_sql(  # pylint: disable=protected-access
+            model, fields, name=self.name, using=using, db_tablespace=self.db_tablespace,
+            col_suffixes=[order for _name, order in self.fields_orders], opclasses=self.opclasses,
+        )
+
+
+@receiver(signals.class_prepared)
+def _add_time_framed_indexes(sender, **kwargs):  # pylint: disable=unused-argument
+    """Index the periods of each concrete time framed model"""
+    options = sender._meta
+    if (not issubclass(sender, TimeFramedMixin) or not sender.time_framed_indexes
+            or options.abstract or options.proxy or options.get_field("start").model is not sender):
+        return
+    periods = Index(fields=["end", "start"])
+    periods.set_name_with_model(sender)
+    # Partial indexes must be named explicitly
+    open_periods = ConditionalIndex(
+        fields=["start"],
+        condition=Q(end__isnull=True),
+        name="{}_{}_open".format(options.db_table[:14], names_digest(options.db_table, "start", length=8)),
+    )
+    # A new list: Meta.indexes may be shared with an abstract parent
+    options.indexes = list(options.indexes) + [periods, open_periods]
+
+
+def _invalidate_saved_periods(sender, using, **kwargs):  # pylint: disable=unused-argument
+    """An object changed: forget the periods now, and again once committed"""
+    invalidate_periods(sender, using)
+    transaction.on_commit(lambda: invalidate_periods(sender, using), using=using)
+
+
+@receiver(signals.class_prepared)
+def _connect_period_cache(sender, **kwargs):  # pylint: disable=unused-argument
+    """Invalidate the period caches of the models enabling them"""
+    if (issubclass(sender, TimeFramedMixin) and (sender.cache_periods or sender.track_current_periods)
+            and not sender._meta.abstract):
+        signals.post_save.connect(_invalidate_saved_periods, sender=sender)
+        signals.post_delete.connect(_invalidate_saved_periods, sender=sender)
+
+
+class AddPeriodExclusionConstraint(Operation):
+    """
+    Forbid overlapping periods in the database, for objects sharing the same
+    key fields. PostgreSQL only (needs the btree_gist extension); a no-op on
+    other backends.
+    """
+
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name, fields, name):
+        self.model_name = model_name
+        self.fields = fields
+        self.name = name
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if schema_editor.connection.vendor != "postgresql" or not self.allow_migrate_model(
+                schema_editor.connection.alias, model):
+            return
+        quote = schema_editor.quote_name
+        keys = ["{} WITH =".format(quote(model._meta.get_field(name).column)) for name in self.fields]
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+        schema_editor.execute(
+            "ALTER TABLE {table} ADD CONSTRAINT {name} EXCLUDE USING gist "
+            "({keys}, tstzrange({start}, {end}, '[)') WITH &&)".format(
+                table=quote(model._meta.db_table),
+                name=quote(self.name),
+                keys=", ".join(keys),
+                start=quote(model._meta.get_field("start").column),
+                end=quote(model._meta.get_field("end").column),
+            )
+        )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if schema_editor.connection.vendor != "postgresql" or not self.allow_migrate_model(
+                schema_editor.connection.alias, model):
+            return
+        schema_editor.execute("ALTER TABLE {} DROP CONSTRAINT {}".format(
+            schema_editor.quote_name(model._meta.db_table), schema_editor.quote_name(self.name)))
+
+    def describe(self):
+        return "Forbid overlapping periods of {} ({})".format(self.model_name, self.name)
@@ -0,0 +1,141 @@
+"""
+In memory representation of a whole hierarchy.
+
+Built by NaiveHierarchyManager.load_tree from a single query, it avoids both
+a query per node and the weight of full model instances.
+"""
+
+import json
+from collections import deque
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class TreeNode:
+    """Compact node of an in memory tree"""
+
+    __slots__ = ("pk", "parent", "children", "depth", "values", "tree")
+
+    def __init__(self, tree, pk, values):
+        self.tree = tree
+        self.pk = pk
+        self.values = values
+        self.parent = None
+        self.children = []
+        self.depth = 0
+
+    def __getitem__(self, field):
+        """Get the value of one of the loaded fields"""
+        return self.values[self.tree.fields.index(field)]
+
+    def __repr__(self):
+        return "<TreeNode: {}>".format(self.pk)
+
+    @property
+    def data(self):
+        """Loaded fields, as a dict"""
+        return dict(zip(self.tree.fields, self.values))
+
+    def iter_depth_first(self):
+        """Iterate over the node and its descendants, depth first (pre-order)"""
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            yield node
+            pending.extend(reversed(node.children))
+
+    def iter_breadth_first(self):
+        """Iterate over the node and its descendants, level by level"""
+        pending = deque([self])
+        while pending:
+            node = pending.popleft()
+            yield node
+            pending.extend(node.children)
+
+    def as_dict(self):
+        """Node and its descendants, as nested dicts"""
+        result = {}
+        pending = [(self, result)]
+        while pending:
+            node, output = pending.pop()
+            output["pk"] = node.pk
+            output.update(zip(node.tree.fields, node.values))
+            output["children"] = [{} for _ in node.children]
+            pending.extend(zip(node.children, output["children"]))
+        return result
+
+
+class Tree:
+    """Whole hierarchy loaded in memory"""
+
+    def __init__(self, fields, rows):
+        """
+        Build a tree from (pk, parent pk, *values) rows.
+
+        Rows that can not be reached from a root (orphans, cycles or nodes
+        whose ancestor was filtered out) are ignored.
+        """
+        self.fields = tuple(fields)
+        self.roots = []
+        self._nodes = {}
+        children = {}
+        for pk, parent_id, *values in rows:
+            node = TreeNode(self, pk, tuple(values))
+            children.setdefault(parent_id, []).append(node)
+        pending = deque(children.pop(None, ()))
+        self.roots.extend(pending)
+        while pending:
+            node = pending.popleft()
+            self._nodes[node.pk] = node
+            node.children = children.pop(node.pk, [])
+            for child in node.children:
+                child.parent = node
+                child.depth = node.depth + 1
+            pending.extend(node.children)
+
+    def __getstate__(self):
+        """Flat rows, parents first: pickling linked nodes would recurse once per level"""
+        rows = [
+            (node.pk, node.parent.pk if node.parent is not None else None) + node.values
+            for node in self.iter_breadth_first()
+        ]
+        return self.fields, rows
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, pk):
+        return pk in self._nodes
+
+    def __getitem__(self, pk):
+        """Get the subtree rooted at the node having this primary key"""
+        return self._nodes[pk]
+
+    def get(self, pk, default=None):
+        """Get the subtree rooted at a node, or default"""
+        return self._nodes.get(pk, default)
+
+    def iter_depth_first(self):
+        """Iterate over all nodes, depth first (pre-order)"""
+        for root in self.roots:
+            yield from root.iter_depth_first()
+
+    def iter_breadth_first(self):
+        """Iterate over all nodes, level by level"""
+        pending = deque(self.roots)
+        while pending:
+            node = pending.popleft()
+            yield node
+            pending.extend(node.children)
+
+    def as_list(self):
+        """Whole tree, as a list of nested dicts"""
+        return [root.as_dict() for root in self.roots]
+
+    def to_json(self, **kwargs):
+        """Whole tree, serialized in JSON"""
+        kwargs.setdefault("cls", DjangoJSONEncoder)
+        return json.dumps(self.as_list(), **kwargs)